@@ -0,0 +1,244 @@
+"""End-to-end latency benchmark for the rallies CLI.
+
+Starts benchmarks/fake_server.py, points the CLI at it and drives scripted
+multi-turn sessions through `Manager.process_prompt_async` on one event loop,
+like the REPL does. Every turn reports its wall time, the time to the first answer
+token, the time spent per stage and the peak memory allocated while it ran. The
+run ends with the input tokens per stage and how many of them hit the prompt cache.
+
+    python benchmarks/e2e.py [--provider openai|gemini] [--sessions 1] [--turns 3]
+        [--script questions.txt] [--cache] [--prefetch] [--json results.jsonl]
+        [--max-turn-ms N] [--max-ttft-ms N] [fake server options ...]
+
+A script has one question per line, blank lines separate sessions, which run
+concurrently on the same Manager. Peak memory is process wide, so with several
+sessions it covers whatever ran alongside a turn. Options not listed
+above (such as --action-latency or --rows) are passed on to the fake server. The run
+exits non-zero when a turn fails or a median exceeds --max-turn-ms or --max-ttft-ms.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+QUESTIONS = [
+    "How did NVDA trade over the last month?",
+    "Compare its valuation with AMD.",
+    "What are the main risks for both into earnings?",
+    "Which one has the stronger technical setup right now?",
+]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--provider", choices=["openai", "gemini"], default="openai")
+    parser.add_argument("--sessions", type=int, default=1, help="sessions run concurrently")
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--script", help="questions file, blank lines separate sessions")
+    parser.add_argument("--cache", action="store_true", help="keep the data cache on")
+    parser.add_argument("--prefetch", action="store_true", help="turn the speculative prefetch on")
+    parser.add_argument("--json", dest="json_path", help="write one JSON record per turn to this file")
+    parser.add_argument("--max-turn-ms", type=float)
+    parser.add_argument("--max-ttft-ms", type=float)
+    return parser.parse_known_args(argv)
+
+
+def load_sessions(options):
+    if options.script:
+        with open(options.script) as f:
+            blocks = f.read().split("\n\n")
+        return [[line.strip() for line in block.splitlines() if line.strip()] for block in blocks if block.strip()]
+    return [
+        [QUESTIONS[(session + turn) % len(QUESTIONS)] for turn in range(options.turns)]
+        for session in range(options.sessions)
+    ]
+
+
+def start_server(server_args):
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_server.py"), "--port", "0"] + server_args,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    url = process.stdout.readline().strip()
+    if not url.startswith("http"):
+        process.kill()
+        raise SystemExit("The fake server did not start")
+    return process, url
+
+
+def configure_environment(url, provider, home, prefetch=False):
+    # Set before rallies is imported, its config paths are read at import time
+    os.environ.update({
+        "HOME": home,
+        "RALLIES_API_URL": url,
+        "OPENAI_BASE_URL": f"{url}/v1",
+        "OPENAI_API_KEY": "benchmark",
+        "GEMINI_API_URL": url,
+        "GEMINI_API_KEY": "benchmark",
+    })
+    if provider == "gemini":
+        os.environ["RALLIES"] = "gemini"
+    os.makedirs(os.path.join(home, ".rallies"), exist_ok=True)
+    with open(os.path.join(home, ".rallies", "config.json"), "w") as f:
+        json.dump({"llm_provider": provider, "prefetch_enabled": prefetch}, f)
+
+
+def turn_reporter():
+    from rallies.reporters import RecordingReporter
+
+    class TurnReporter(RecordingReporter):
+        """Records a turn and when its first answer token arrived"""
+
+        def __init__(self):
+            super().__init__()
+            self.started = time.perf_counter()
+            self.first_token = None
+
+        def answer_chunk(self, chunk):
+            if self.first_token is None and chunk:
+                self.first_token = time.perf_counter() - self.started
+
+    return TurnReporter()
+
+
+async def run_session(manager, session_index, questions):
+    records = []
+    conversation = []
+    for turn_index, question in enumerate(questions):
+        reporter = turn_reporter()
+        conversation.append({"role": "user", "content": question})
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        started = time.perf_counter()
+        error = None
+        try:
+            await manager.process_prompt_async(question, conversation, reporter)
+        except Exception as e:
+            error = str(e)
+        wall = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+
+        stages = {}
+        for timing in reporter.timings:
+            stages[timing["stage"]] = stages.get(timing["stage"], 0) + timing["seconds"]
+        records.append({
+            "session": session_index,
+            "turn": turn_index,
+            "question": question,
+            "wall": round(wall, 4),
+            "ttft": round(reporter.first_token, 4) if reporter.first_token is not None else None,
+            "stages": {stage: round(seconds, 4) for stage, seconds in stages.items()},
+            "steps": len(reporter.steps),
+            "tokens": reporter.tokens,
+            "peak_kb": round(peak / 1024, 1),
+            "error": error or reporter.error_message,
+        })
+    return records
+
+
+async def run_sessions(sessions, use_cache):
+    from rallies.manager import Manager
+
+    manager = Manager(use_cache=use_cache, concurrent_turns=len(sessions))
+    try:
+        results = await asyncio.gather(*[
+            run_session(manager, index, questions) for index, questions in enumerate(sessions)
+        ])
+    finally:
+        await manager.agent.close_async()
+    return [record for records in results for record in records]
+
+
+def ms(seconds):
+    return f"{seconds * 1000:8.0f}" if seconds is not None else "       -"
+
+
+def report(records, wall):
+    stages = sorted({stage for record in records for stage in record["stages"]})
+    print(f"{'session':>7} {'turn':>4} {'wall ms':>8} {'ttft ms':>8} {'steps':>5} {'peak KB':>9}  stages (ms)")
+    for record in records:
+        breakdown = " ".join(f"{stage}={record['stages'][stage] * 1000:.0f}" for stage in stages if stage in record["stages"])
+        print(f"{record['session']:>7} {record['turn']:>4} {ms(record['wall'])} {ms(record['ttft'])} "
+              f"{record['steps']:>5} {record['peak_kb']:>9.0f}  {breakdown}")
+        if record["error"]:
+            print(f"{'':>13}error: {record['error']}")
+
+    print()
+    walls = [record["wall"] for record in records]
+    ttfts = [record["ttft"] for record in records if record["ttft"] is not None]
+    print(f"turns: {len(records)}   total wall: {wall:.2f}s")
+    print(f"turn wall      median {ms(statistics.median(walls))} ms   max {ms(max(walls))} ms")
+    if ttfts:
+        print(f"first token    median {ms(statistics.median(ttfts))} ms   max {ms(max(ttfts))} ms")
+    for stage in stages:
+        values = [record["stages"][stage] for record in records if stage in record["stages"]]
+        print(f"{stage:<14} median {ms(statistics.median(values))} ms   total {ms(sum(values))} ms")
+    print(f"peak memory    max turn {max(record['peak_kb'] for record in records):.0f} KB   "
+          f"process max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+    from rallies.prefetch import prefetch_stats
+    if prefetch_stats["issued"]:
+        print(f"prefetch       issued {prefetch_stats['issued']}   used {prefetch_stats['used']}   "
+              f"hit rate {prefetch_stats['used'] / prefetch_stats['issued'] * 100:.0f}%")
+
+    from rallies.llm import usage_stats
+    if usage_stats:
+        print()
+        print(f"{'stage':<14} {'calls':>5} {'input':>9} {'cached':>9} {'hit rate':>8}")
+        for stage, usage in sorted(usage_stats.items()):
+            rate = usage["cached"] / usage["input"] * 100 if usage["input"] else 0
+            print(f"{stage:<14} {usage['calls']:>5} {usage['input']:>9} {usage['cached']:>9} {rate:>7.0f}%")
+
+
+def main(argv=None):
+    options, server_args = parse_args(argv)
+    sessions = load_sessions(options)
+    process, url = start_server(server_args)
+    try:
+        with tempfile.TemporaryDirectory() as home:
+            configure_environment(url, options.provider, home, options.prefetch)
+            from rallies import console
+            console.file = io.StringIO()
+
+            tracemalloc.start()
+            started = time.perf_counter()
+            records = asyncio.run(run_sessions(sessions, options.cache))
+            wall = time.perf_counter() - started
+            tracemalloc.stop()
+    finally:
+        process.kill()
+        process.wait()
+
+    report(records, wall)
+    if options.json_path:
+        with open(options.json_path, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+
+    failed = False
+    if any(record["error"] for record in records):
+        print("FAIL: some turns failed")
+        failed = True
+    walls = [record["wall"] for record in records]
+    if options.max_turn_ms and statistics.median(walls) * 1000 > options.max_turn_ms:
+        print(f"FAIL: median turn {statistics.median(walls) * 1000:.0f} ms > {options.max_turn_ms:.0f} ms")
+        failed = True
+    ttfts = [record["ttft"] for record in records if record["ttft"] is not None]
+    if options.max_ttft_ms and ttfts and statistics.median(ttfts) * 1000 > options.max_ttft_ms:
+        print(f"FAIL: median first token {statistics.median(ttfts) * 1000:.0f} ms > {options.max_ttft_ms:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,347 @@
+"""Local stand-in for rallies.ai, the OpenAI Responses API and the Gemini API.
+
+Implements the endpoints the CLI talks to with canned but realistically shaped
+answers, so that performance can be measured without network access or API
+costs:
+
+    POST /api/complete-cli-action                         rallies.ai actions
+    POST /v1/responses                                    OpenAI, plain and streaming (SSE)
+    POST /v1beta/models/<model>:generateContent           Gemini
+    POST /v1beta/models/<model>:streamGenerateContent     Gemini streaming (JSON array or alt=sse)
+
+Point the CLI at it with
+
+    RALLIES_API_URL=http://127.0.0.1:8765
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1
+    GEMINI_API_URL=http://127.0.0.1:8765
+
+    python benchmarks/fake_server.py [--port 8765] [--llm-latency 0.3] [--token-latency 0.02]
+        [--action-latency 0.5] [--jitter 0.2] [--steps 3] [--rounds 1] [--rows 250]
+        [--answer-words 300] [--fail-model NAME ...]
+
+The planner returns --steps steps for --rounds rounds per question and then an empty
+plan. Actions return a price table of --rows rows. The listening URL is printed on the
+first line of stdout, so --port 0 picks a free port. Calls to a --fail-model get a 503,
+which exercises the model fallbacks.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from rallies.agent.prompts import agent_prompt, answer_prompt, batch_summary_prompt, compact_prompt, summary_prompt
+
+SUMMARY_PREFIX = "Summary:"
+WORDS = (
+    "revenue margin guidance momentum support resistance volume earnings outlook valuation "
+    "multiple sector rotation breakout drawdown volatility catalyst consensus estimate"
+).split()
+
+
+def classify(prompt):
+    """Which CLI call a system prompt belongs to"""
+    prompt = prompt.lstrip()
+    for kind, text in (
+        ("plan", agent_prompt),
+        ("batch_summary", batch_summary_prompt),
+        ("summary", summary_prompt),
+        ("compact", compact_prompt),
+        ("answer", answer_prompt),
+    ):
+        if prompt.startswith(text.strip()[:200]):
+            return kind
+    return "answer"
+
+
+class Scenario:
+    """Latencies and payload sizes of the fake endpoints"""
+
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options.seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.prefixes = {}
+
+    def delay(self, seconds):
+        if seconds <= 0:
+            return
+        with self.lock:
+            jitter = 1 + self.options.jitter * (2 * self.random.random() - 1)
+        time.sleep(seconds * jitter)
+
+    def cached_tokens(self, key, messages):
+        """Returns (input tokens, cached tokens), mimicking provider prefix caching
+
+        A request reads from the cache the longest prefix it shares with a recent
+        request with the same key, at least 1024 tokens and then in 128 token blocks.
+        """
+        text = "".join(f"{m.get('role')}:{m.get('content')}\n" for m in messages)
+        with self.lock:
+            recent = self.prefixes.setdefault(key, [])
+            common = max((len(os.path.commonprefix([previous, text])) for previous in recent), default=0)
+            recent.append(text)
+            del recent[:-8]
+        common //= 4
+        return len(text) // 4, common // 128 * 128 if common >= 1024 else 0
+
+    def plan(self, messages):
+        # Rounds already planned this turn, counted back to the previous answer
+        rounds = 0
+        for message in reversed(messages):
+            if message.get("role") != "assistant":
+                continue
+            if not str(message.get("content", "")).startswith("[{"):
+                break
+            rounds += 1
+        if rounds >= self.options.rounds:
+            return []
+        question = next(
+            (m["content"] for m in reversed(messages) if m.get("role") == "user" and not m["content"].startswith(SUMMARY_PREFIX)),
+            "",
+        )
+        steps = [
+            {"title": f"Step {rounds + 1}.{index + 1}", "description": f"I need to look up part {index + 1} of: {question[:60]}"}
+            for index in range(self.options.steps)
+        ]
+        # Like the real planner, a first round about named tickers starts with their prices and news
+        tickers = " and ".join(dict.fromkeys(re.findall(r"\b[A-Z]{2,5}\b", question)))
+        if rounds == 0 and tickers:
+            steps[:2] = [
+                {"title": f"Get latest {tickers} prices", "description": f"Let me pull {tickers} pricing first"},
+                {"title": f"Get latest {tickers} news", "description": f"I need recent {tickers} headlines"},
+            ][:len(steps)]
+        return steps
+
+    def text(self, words):
+        with self.lock:
+            return " ".join(self.random.choice(WORDS) for _ in range(words))
+
+    def answer(self):
+        paragraphs = []
+        remaining = self.options.answer_words
+        while remaining > 0:
+            words = min(remaining, 60)
+            paragraphs.append(self.text(words).capitalize() + ".")
+            remaining -= words
+        return "## Answer\n\n" + "\n\n".join(paragraphs)
+
+    def respond(self, kind, messages):
+        """Text of the response to an LLM call"""
+        if kind == "plan":
+            return json.dumps({"steps": self.plan(messages)})
+        if kind == "batch_summary":
+            steps = sum(1 for m in messages if re.match(r"Step \d+:", str(m.get("content", ""))))
+            return json.dumps({"summaries": [f"{SUMMARY_PREFIX} {self.text(12)}" for _ in range(steps)]})
+        if kind == "summary":
+            return f"{SUMMARY_PREFIX} {self.text(15)}"
+        if kind == "compact":
+            return "\n".join(f"- {self.text(10)}" for _ in range(5))
+        return self.answer()
+
+    def action(self, payload):
+        rows = []
+        price = 100.0
+        for index in range(self.options.rows):
+            price *= math.exp(0.02 * (self.random.random() - 0.5))
+            day = time.strftime("%Y-%m-%d", time.gmtime(1700000000 + index * 86400))
+            rows.append({"date": day, "open": round(price * 0.99, 2), "close": round(price, 2), "volume": 1000000 + index})
+        return {
+            "allowed": True,
+            "results": {"title": payload.get("title"), "summary": self.text(40), "prices": rows},
+            "current_usage": self.requests,
+            "limit": 100000,
+        }
+
+
+def chunks(text, size=12):
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    scenario = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_chunked(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def end_chunked(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        scenario = self.scenario
+        with scenario.lock:
+            scenario.requests += 1
+        path = self.path.split("?")[0]
+        body = self.read_json()
+        if path.endswith("/api/complete-cli-action"):
+            scenario.delay(scenario.options.action_latency)
+            self.send_json(scenario.action(body))
+        elif path.endswith("/responses") or ":generateContent" in path or ":streamGenerateContent" in path:
+            model = body.get("model") or path.rsplit("/", 1)[-1].split(":")[0]
+            if model in scenario.options.fail_model:
+                scenario.delay(scenario.options.llm_latency)
+                self.send_json({"error": {"code": 503, "message": f"{model} is overloaded", "status": "UNAVAILABLE"}}, status=503)
+            elif path.endswith("/responses"):
+                self.openai(body)
+            else:
+                self.gemini(body, stream=":streamGenerateContent" in path, sse="alt=sse" in self.path)
+        else:
+            self.send_json({"error": {"message": f"Unknown path {path}"}}, status=404)
+
+    def openai(self, body):
+        scenario = self.scenario
+        messages = body.get("input") or []
+        if isinstance(messages, str):
+            messages = [{"role": "user", "content": messages}]
+        kind = classify(messages[0].get("content", "")) if messages else "answer"
+        text = scenario.respond(kind, messages)
+        input_tokens, cached_tokens = scenario.cached_tokens(body.get("prompt_cache_key") or kind, messages)
+        scenario.delay(scenario.options.llm_latency)
+
+        response = {
+            "id": f"resp_{scenario.requests}",
+            "object": "response",
+            "created_at": int(time.time()),
+            "model": body.get("model"),
+            "status": "completed",
+            "output": [{
+                "type": "message",
+                "id": f"msg_{scenario.requests}",
+                "status": "completed",
+                "role": "assistant",
+                "content": [{"type": "output_text", "text": text, "annotations": []}],
+            }],
+            "usage": {"input_tokens": input_tokens, "input_tokens_details": {"cached_tokens": cached_tokens},
+                      "output_tokens": len(text) // 4, "output_tokens_details": {"reasoning_tokens": 0},
+                      "total_tokens": input_tokens + len(text) // 4},
+        }
+        if not body.get("stream"):
+            self.send_json(response)
+            return
+
+        self.start_chunked("text/event-stream")
+        sequence = 0
+        for index, chunk in enumerate(chunks(text)):
+            if index:
+                scenario.delay(scenario.options.token_latency)
+            event = {"type": "response.output_text.delta", "item_id": response["output"][0]["id"],
+                     "output_index": 0, "content_index": 0, "delta": chunk, "sequence_number": sequence}
+            self.write_chunk(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n")
+            sequence += 1
+        event = {"type": "response.completed", "response": response, "sequence_number": sequence}
+        self.write_chunk(f"event: {event['type']}\ndata: {json.dumps(event)}\n\n")
+        self.end_chunked()
+
+    def gemini(self, body, stream, sse):
+        scenario = self.scenario
+        system = "".join(part.get("text", "") for part in (body.get("systemInstruction") or {}).get("parts", []))
+        messages = [{"role": "system", "content": system}] if system else []
+        for content in body.get("contents", []):
+            role = "assistant" if content.get("role") == "model" else "user"
+            messages.extend({"role": role, "content": part.get("text", "")} for part in content.get("parts", []))
+        kind = classify(messages[0]["content"]) if messages else "answer"
+        text = scenario.respond(kind, messages)
+        input_tokens, cached_tokens = scenario.cached_tokens(kind, messages)
+        usage = {"promptTokenCount": input_tokens, "cachedContentTokenCount": cached_tokens,
+                 "candidatesTokenCount": len(text) // 4, "totalTokenCount": input_tokens + len(text) // 4}
+        scenario.delay(scenario.options.llm_latency)
+
+        def candidate(part, last=True):
+            body = {"candidates": [{"content": {"parts": [{"text": part}], "role": "model"}, "finishReason": "STOP", "index": 0}]}
+            if last:
+                body["usageMetadata"] = usage
+            return body
+
+        if not stream:
+            self.send_json(candidate(text))
+            return
+
+        self.start_chunked("text/event-stream" if sse else "application/json")
+        if not sse:
+            self.write_chunk("[")
+        parts = list(chunks(text, 48))
+        for index, chunk in enumerate(parts):
+            if index:
+                scenario.delay(scenario.options.token_latency)
+            data = json.dumps(candidate(chunk, last=index == len(parts) - 1))
+            if sse:
+                self.write_chunk(f"data: {data}\n\n")
+            else:
+                self.write_chunk(("," if index else "") + data)
+        if not sse:
+            self.write_chunk("]")
+        self.end_chunked()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds before an LLM response starts")
+    parser.add_argument("--token-latency", type=float, default=0.02, help="seconds between streamed chunks")
+    parser.add_argument("--action-latency", type=float, default=0.5, help="seconds per action request")
+    parser.add_argument("--jitter", type=float, default=0.2, help="relative random variation of every latency")
+    parser.add_argument("--steps", type=int, default=3, help="plan steps per round")
+    parser.add_argument("--rounds", type=int, default=1, help="plan rounds per question")
+    parser.add_argument("--rows", type=int, default=250, help="rows in each action result")
+    parser.add_argument("--answer-words", type=int, default=300)
+    parser.add_argument("--fail-model", action="append", default=[], help="answer calls to this model with 503, repeatable")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def serve(options):
+    """Start the server in a daemon thread, returns (server, base url)"""
+    handler = type("ScenarioHandler", (Handler,), {"scenario": Scenario(options)})
+    server = ThreadingHTTPServer((options.host, options.port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    server, url = serve(options)
+    print(url, flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""Startup benchmark for the rallies CLI.
+
+Measures, in fresh interpreters, the import time of `rallies.cli`, the time a
+non-chat subcommand takes, and the time until the REPL is ready for its first
+prompt. It also checks that none of these paths import the heavy dependencies,
+and exits non-zero when one does or a time budget is exceeded.
+
+    python benchmarks/startup.py [--runs 5] [--max-import-ms 300] [--max-prompt-ms 600]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ["openai", "google.generativeai", "tiktoken", "numpy", "requests", "httpx"]
+
+IMPORT_CLI = """
+import time, sys, json
+start = time.perf_counter()
+import rallies.cli
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in HEAVY if m in sys.modules]}))
+"""
+
+SUBCOMMAND = """
+import time, sys, json, io
+start = time.perf_counter()
+sys.argv = ["rallies", "provider"]
+from rallies import console
+console.file = io.StringIO()
+from rallies.cli import main
+main()
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in HEAVY if m in sys.modules]}))
+"""
+
+FIRST_PROMPT = """
+import time, sys, json, io
+start = time.perf_counter()
+from rallies import console
+console.file = io.StringIO()
+from rallies.cli import display_application_banner
+from rallies.manager import Manager
+from prompt_toolkit import PromptSession
+from prompt_toolkit.history import InMemoryHistory
+display_application_banner()
+manager = Manager()
+session = PromptSession(history=InMemoryHistory())
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "loaded": [m for m in HEAVY if m in sys.modules]}))
+"""
+
+
+def run_snippet(snippet, home):
+    env = dict(os.environ, HOME=home, PYTHONWARNINGS="ignore")
+    code = f"HEAVY = {HEAVY_MODULES!r}\n{snippet}"
+    output = subprocess.run(
+        [sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure(name, snippet, runs, home):
+    results = [run_snippet(snippet, home) for _ in range(runs)]
+    seconds = [result["seconds"] for result in results]
+    loaded = sorted({module for result in results for module in result["loaded"]})
+    return {
+        "name": name,
+        "median_ms": statistics.median(seconds) * 1000,
+        "min_ms": min(seconds) * 1000,
+        "heavy_modules": loaded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, default=None)
+    parser.add_argument("--max-prompt-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    failures = []
+    with tempfile.TemporaryDirectory() as home:
+        reports = [
+            measure("import rallies.cli", IMPORT_CLI, args.runs, home),
+            measure("rallies provider", SUBCOMMAND, args.runs, home),
+            measure("time to first prompt", FIRST_PROMPT, args.runs, home),
+        ]
+
+    for report in reports:
+        print(
+            f"{report['name']:<24} median {report['median_ms']:8.1f} ms   "
+            f"min {report['min_ms']:8.1f} ms   heavy: {', '.join(report['heavy_modules']) or '-'}"
+        )
+        if report["heavy_modules"]:
+            failures.append(f"{report['name']} imported {', '.join(report['heavy_modules'])}")
+
+    budgets = [(reports[0], args.max_import_ms), (reports[2], args.max_prompt_ms)]
+    for report, budget in budgets:
+        if budget is not None and report["median_ms"] > budget:
+            failures.append(f"{report['name']} took {report['median_ms']:.1f} ms (budget {budget:.0f} ms)")
+
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
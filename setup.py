@@ -7,6 +7,7 @@ setup(
     install_requires=[
         "rich",
         "requests",
+        "httpx",
         "inquirer",
         "tiktoken",
         "openai",
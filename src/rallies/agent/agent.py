@@ -1,20 +1,97 @@
 import os
-import numpy as np
-import subprocess
-import tempfile
-import requests
-from .prompts import agent_prompt, answer_prompt, summary_prompt, compact_prompt
-from ..llm import LLM
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from .prompts import agent_prompt, answer_prompt, summary_prompt, batch_summary_prompt, compact_prompt
+from .prompts import plan_schema, batch_summary_schema
+from ..llm import LLM, record_json_path
+from ..jsonstream import JSONArrayStream
+from ..config import get_api_url
+from ..tracing import tracer
 
 
 class Agent:
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, pool_connections=2, pool_maxsize=10, cache=None, api_url=None):
         self.current_dir = os.path.dirname(os.path.abspath(__file__))
         self.api_key = api_key
+        self.api_url = api_url or get_api_url()
         self.last_usage = 0
         self.last_limit = 0
+        self._llm = None
+        self.cache = cache
+        self.use_cache = cache is not None
+        self.context = None
+        self.tables = None
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._session = None
+        self._async_session = None
+        self._async_session_loop = None
+        # Optional semaphore shared by every session of a server, each async LLM
+        # and action call holds one of its slots while in flight
+        self.limiter = None
+        self.inflight = 0
+
+    @property
+    def session(self):
+        """One keep-alive session for every rallies.ai request, created on first use
+
+        The pool is sized so that concurrent plan steps do not wait on (or discard)
+        pooled connections.
+        """
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+        return self._session
+
+    @property
+    def async_session(self):
+        """The async counterpart of `session`, kept per event loop since its connections are bound to it"""
+        loop = asyncio.get_running_loop()
+        if self._async_session is None or self._async_session_loop is not loop:
+            import httpx
+            limits = httpx.Limits(max_connections=self.pool_maxsize, max_keepalive_connections=self.pool_maxsize)
+            self._async_session = httpx.AsyncClient(limits=limits)
+            self._async_session_loop = loop
+        return self._async_session
+
+    @property
+    def llm(self):
+        """The LLM for the provider configured when it was first used"""
+        if self._llm is None:
+            self._llm = LLM()
+        return self._llm
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+    async def close_async(self):
+        self.close()
+        if self._async_session is not None and self._async_session_loop is asyncio.get_running_loop():
+            await self._async_session.aclose()
+        self._async_session = None
         
+    @asynccontextmanager
+    async def slot(self):
+        if self.limiter is None:
+            yield
+            return
+        async with self.limiter:
+            self.inflight += 1
+            try:
+                yield
+            finally:
+                self.inflight -= 1
+
     def parse_messages(self, messages: list) -> list:
+         if self.context is not None:
+             messages = self.context.fit(messages)
          parsed_messages = []
          for message in messages:
              if isinstance(message, dict) and "role" in message and "content" in message:
@@ -24,76 +101,161 @@ class Agent:
                  })
          return parsed_messages
 
-    def run(self, messages: str) -> str:
+    def plan_messages(self, messages):
         message = []
         message.append({"role": "developer", "content": agent_prompt})
         message.extend(self.parse_messages(messages))
-        response = LLM().prompt(message, requires_json = True)
-        return response
-    
-    def action(self, question, title, description):
-        try:
-            headers = {"Content-Type": "application/json"}
-            payload = {
-                "question": question,
-                "title": title,
-                "description": description
-            }
-            
-            if self.api_key:
-                headers["Authorization"] = f"Bearer {self.api_key}"
+        return message
+
+    async def run_async(self, messages):
+        async with self.slot():
+            with tracer.span("agent.plan"):
+                return await self.llm.prompt_async(self.plan_messages(messages), requires_json = True, schema = plan_schema, stage = "plan")
+
+    async def run_stream_async(self, messages):
+        """Stream the planner and yield each plan item as soon as its JSON object closes"""
+        parser = JSONArrayStream()
+        items = 0
+        started = time.perf_counter()
+        async with self.slot():
+            stream = self.llm.prompt_stream_async(self.plan_messages(messages), schema = plan_schema, stage = "plan")
+            try:
+                async for chunk in stream:
+                    if parser.closed:
+                        # Read the rest of the stream, it ends with the usage of the call
+                        continue
+                    for item in parser.feed(chunk):
+                        if isinstance(item, dict):
+                            items += 1
+                            if items == 1:
+                                tracer.record("agent.plan.first_step", time.perf_counter() - started)
+                            yield item
+                    if parser.closed:
+                        record_json_path("streamed")
+            finally:
+                await stream.aclose()
+        tracer.record("agent.plan", time.perf_counter() - started, streamed=True, steps=items)
+
+        # Fall back to a regular planner call when the stream was not a JSON array
+        if not items and not parser.closed:
+            for item in await self.run_async(messages):
+                yield item
+
+    def action_request(self, question, title, description):
+        """Returns the (payload, headers) of an action request"""
+        headers = {"Content-Type": "application/json"}
+        payload = {
+            "question": question,
+            "title": title,
+            "description": description
+        }
+        
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return payload, headers
+
+    def action_result(self, status_code, result):
+        """Returns the results of an action response, raising on errors and denied requests"""
+        if status_code == 200:
+            result = result()
+            if result.get("allowed") == False:
+                error_msg = result.get("error", "Unknown error")
+                if "Rate limit exceeded" in error_msg:
+                    error_display = f"[red]⚠ Rate limit reached:[/red] {error_msg}"
+                elif "Invalid API key" in error_msg:
+                    error_display = f"[red]⚠ Authentication failed:[/red] Invalid API key"
+                else:
+                    error_display = f"[red]⚠ Access denied:[/red] {error_msg}"
+                raise Exception(error_display)
             
-            response = requests.post(
-                "https://rallies.ai/api/complete-cli-action",
-                json=payload,
-                headers=headers,
-                timeout=180
-            )
-            if response.status_code == 200:
-                result = response.json()
-                if result.get("allowed") == False:
-                    error_msg = result.get("error", "Unknown error")
-                    if "Rate limit exceeded" in error_msg:
-                        error_display = f"[red]⚠ Rate limit reached:[/red] {error_msg}"
-                    elif "Invalid API key" in error_msg:
-                        error_display = f"[red]⚠ Authentication failed:[/red] Invalid API key"
-                    else:
-                        error_display = f"[red]⚠ Access denied:[/red] {error_msg}"
-                    raise Exception(error_display)
-                
-                self.last_usage = result.get("current_usage", 0)
-                self.last_limit = result.get("limit", 0)
-                return result.get("results", "No results returned")
-            else:
-                raise Exception(f"[red]⚠ API Error:[/red] Request failed with status {response.status_code}")
-                
-        except requests.exceptions.RequestException as e:
+            self.last_usage = result.get("current_usage", 0)
+            self.last_limit = result.get("limit", 0)
+            return result.get("results", "No results returned")
+        else:
+            raise Exception(f"[red]⚠ API Error:[/red] Request failed with status {status_code}")
+
+    async def action_async(self, question, title, description):
+        import httpx
+        try:
+            payload, headers = self.action_request(question, title, description)
+            async with self.slot():
+                with tracer.span("agent.action", title=title):
+                    response = await self.async_session.post(f"{self.api_url}/api/complete-cli-action", json=payload, headers=headers, timeout=180)
+            return self.action_result(response.status_code, response.json)
+
+        except httpx.HTTPError as e:
             raise Exception(f"[red]⚠ Network Error:[/red] {str(e)}")
         except Exception as e:
             if "[red]" in str(e):
                 raise
             raise Exception(f"[red]⚠ Error:[/red] {str(e)}")
     
-    def summarize(self, messages):
+    async def cached_action_async(self, question, title, description):
+        """Run an action through the result cache, returns (result, served_from_cache)"""
+        if self.cache is None or not self.use_cache:
+            return await self.action_async(question, title, description), False
+
+        result = self.cache.get(question, title, description)
+        if result is not None:
+            return result, True
+
+        result = await self.action_async(question, title, description)
+        self.cache.put(question, title, description, result)
+        return result, False
+
+    def summary_messages(self, messages):
         message = []
         message.append({"role": "developer", "content": summary_prompt})
         message.extend(self.parse_messages(messages))
-        summary = LLM().prompt(message)
-        return summary
+        return message
+
+    async def summarize_async(self, messages):
+        async with self.slot():
+            with tracer.span("agent.summarize"):
+                return await self.llm.prompt_async(self.summary_messages(messages), stage = "summary")
     
-    def answer(self, question, messages):
+    def batch_summary_messages(self, messages, steps):
+        step_messages = []
+        for number, (item, result) in enumerate(steps, 1):
+            step_messages.append({"role": "user", "content": f"Step {number}: {item['title']} - {item['description']}"})
+            step_messages.append({"role": "user", "content": str(result), "type": "data"})
+
         message = []
-        answer_prompt_formatted = answer_prompt.replace("--question--", question)
-        message.append({"role": "developer", "content": answer_prompt_formatted})
+        message.append({"role": "developer", "content": batch_summary_prompt})
+        message.extend(self.parse_messages(messages + step_messages))
+        return message
+
+    async def summarize_batch_async(self, messages, steps):
+        """Summarize several (item, result) steps with one call, returns a list of summaries"""
+        async with self.slot():
+            with tracer.span("agent.summarize_batch", steps=len(steps)):
+                return await self.llm.prompt_async(self.batch_summary_messages(messages, steps), requires_json = True, schema = batch_summary_schema, stage = "batch_summary")
+
+    def answer_messages(self, question, messages):
+        # The question goes last so that the prompt and history stay a cacheable prefix
+        message = []
+        message.append({"role": "developer", "content": answer_prompt})
         message.extend(self.parse_messages(messages))
-        for chunk in LLM().prompt_stream(message):
-            yield chunk
+        message.append({"role": "user", "content": f"The question we have to answer is this: {question}"})
+        return message
+
+    async def answer_async(self, question, messages):
+        started = time.perf_counter()
+        chunks = 0
+        async with self.slot():
+            async for chunk in self.llm.prompt_stream_async(self.answer_messages(question, messages), stage = "answer"):
+                if not chunks:
+                    tracer.record("agent.answer.first_chunk", time.perf_counter() - started)
+                chunks += 1
+                yield chunk
+        tracer.record("agent.answer", time.perf_counter() - started, chunks=chunks)
 
     def compact(self, messages):
         message = []
         message.append({"role": "developer", "content": compact_prompt})
         message.extend(self.parse_messages(messages))
-        summary = LLM().prompt(message)
+        with tracer.span("agent.compact", messages=len(messages)):
+            summary = self.llm.prompt(message, stage = "compact")
 
         messages.clear()
         messages.append({"role": "user", "content": summary})
@@ -49,6 +49,14 @@ Keeping in view the entire conversation, your job is to summarize the informatio
 Do no return anything other than the summary. Do not start with any other prefix or suffix.
 """
 
+batch_summary_prompt = """
+You are an information summarizer for a financial analyst agent. You are going to be given a question, data retrieved at various steps, and then several steps that were just executed, each with what was required for it followed by the data it retrieved.
+
+Keeping in view the entire conversation, your job is to summarize the information of each of the latest steps concisely that the user can quickly read. Each summary should be less than 50 words. If you think there is a lot of data for a step, feel free to go beyond 50 words (in that case, use line breaks to build paragraphs)
+
+Your output must be a JSON list of strings with exactly one summary per step, in the same order as the steps e.g ["summary of the first step", "summary of the second step"]. Your output must be a valid JSON format, do not start with ```json or any other prefix or suffix.
+"""
+
 compact_prompt = """
 You are an information compacting agent for a financial analyst agent. You are going to be given a full conversation, data retrieved at various steps, and the latest action as well as what was required for that action.
 
@@ -67,5 +75,44 @@ You are a financial analyst who is going to review the content we have gathered
 
 Keep the markdown simple, text, bullets, tables etc. Dont make boxes and stuff.
 
-The question we have to answer is this: --question--
-"""
\ No newline at end of file
+The question we have to answer is the last message of the conversation.
+"""
+
+# Structured output schemas, providers need an object at the top level so
+# lists are wrapped in `key` and unwrapped again by the LLM layer
+plan_schema = {
+    "name": "plan",
+    "key": "steps",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "steps": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "title": {"type": "string"},
+                        "description": {"type": "string"},
+                    },
+                    "required": ["title", "description"],
+                    "additionalProperties": False,
+                },
+            }
+        },
+        "required": ["steps"],
+        "additionalProperties": False,
+    },
+}
+
+batch_summary_schema = {
+    "name": "summaries",
+    "key": "summaries",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "summaries": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["summaries"],
+        "additionalProperties": False,
+    },
+}
@@ -0,0 +1,77 @@
+import sys
+import json
+import time
+import asyncio
+
+
+def read_questions(source=None):
+    """Read questions from a file, or from stdin when the source is None or "-", one per line"""
+    if source is None or source == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(source, "r") as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+async def answer_question(manager, question):
+    """Run one headless turn and build its JSON Lines record"""
+    from .reporters import RecordingReporter
+    from .helpers import TokenCounter
+
+    reporter = RecordingReporter()
+    conversation = [{"role": "user", "content": question}]
+    started = time.time()
+    answer = ""
+    error = None
+    try:
+        answer = await manager.run_turn_async(question, conversation, reporter, token_counter=TokenCounter())
+    except Exception as e:
+        error = str(e)
+
+    record = {"question": question, "answer": answer}
+    record.update(reporter.record())
+    record["error"] = error or record["error"]
+    record["seconds"] = round(time.time() - started, 3)
+    return record
+
+
+def run_batch(questions, workers=4, output=None, use_cache=True):
+    """Answer questions concurrently and write one JSON record per line in input order
+
+    All questions run as tasks on one event loop and share one Manager, and with it the
+    HTTP pool, LLM clients and data cache. Returns the number of questions that failed.
+    """
+    return asyncio.run(run_batch_async(questions, workers, output, use_cache))
+
+
+async def run_batch_async(questions, workers=4, output=None, use_cache=True, manager=None):
+    """run_batch on the running loop, with a given manager it is used and left open"""
+    from .manager import Manager
+
+    output = output or sys.stdout
+    workers = max(1, min(workers, len(questions) or 1))
+    owned = manager is None
+    if owned:
+        manager = Manager(use_cache=use_cache, concurrent_turns=workers)
+    slots = asyncio.Semaphore(workers)
+
+    async def answer(question):
+        async with slots:
+            return await answer_question(manager, question)
+
+    failures = 0
+    tasks = [asyncio.ensure_future(answer(question)) for question in questions]
+    try:
+        for task in tasks:
+            record = await task
+            if record["error"]:
+                failures += 1
+            output.write(json.dumps(record, default=str) + "\n")
+            output.flush()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if owned:
+            await manager.agent.close_async()
+    return failures
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from .config import CONFIG_DIR
+
+CACHE_FILE = os.path.join(CONFIG_DIR, "action_cache.json")
+
+# Every live cache, flushed by one exit handler. A cache with unsaved entries is kept
+# alive by its save timer, the others may go with the Manager that owned them.
+_caches = weakref.WeakSet()
+
+
+def flush_all():
+    for cache in list(_caches):
+        cache.flush()
+
+
+atexit.register(flush_all)
+
+
+def normalize(text):
+    """Lowercases and collapses whitespace so trivially different requests share an entry."""
+    return " ".join(str(text or "").lower().split())
+
+
+def cache_key(question, title, description):
+    raw = "\x1f".join(normalize(part) for part in (question, title, description))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class ActionCache:
+    """Size-bounded LRU cache of action results with a TTL per entry, persisted as JSON.
+
+    New entries are written by a background timer `save_delay` seconds after the first
+    unsaved one, so a burst of misses costs one write and never blocks the event loop.
+    Whatever is still unsaved is written at exit.
+    """
+
+    def __init__(self, path=CACHE_FILE, ttl=900, max_entries=256, save_delay=2.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.save_delay = save_delay
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._timer = None
+        self._dirty = False
+        _caches.add(self)
+
+    def _load(self):
+        # Loaded on first use so that startup never pays for reading the file
+        if self._entries is not None:
+            return
+        self._entries = OrderedDict()
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError, OSError):
+            return
+        now = time.time()
+        for entry in data.get("entries", []):
+            if entry.get("expires", 0) > now and "key" in entry:
+                self._entries[entry["key"]] = entry
+        self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _schedule_save(self):
+        # Called with the lock held
+        self._dirty = True
+        if self._timer is None:
+            self._timer = threading.Timer(self.save_delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Write unsaved entries to the file now"""
+        with self._save_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return
+                self._dirty = False
+                # Entries are never changed in place, a shallow copy is a consistent snapshot
+                entries = list(self._entries.values())
+            self._save(entries)
+
+    def _save(self, entries):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".action_cache.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"entries": entries}, f)
+            os.replace(tmp_path, self.path)
+        except (OSError, TypeError, ValueError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get(self, question, title, description):
+        """Returns the cached result or None when it is missing or expired."""
+        key = cache_key(question, title, description)
+        with self._lock:
+            self._load()
+            entry = self._entries.get(key)
+            if entry is None or entry["expires"] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["result"]
+
+    def put(self, question, title, description, result, ttl=None):
+        key = cache_key(question, title, description)
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._load()
+            self._entries[key] = {"key": key, "expires": time.time() + ttl, "result": result}
+            self._entries.move_to_end(key)
+            self._evict()
+            self._schedule_save()
+
+    def clear(self):
+        with self._save_lock, self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._dirty = False
+            self._entries = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._entries)
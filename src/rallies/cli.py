@@ -2,13 +2,12 @@ import sys
 import os
 import json
 import glob
+import asyncio
 from datetime import datetime
 from rich.text import Text
-from rallies.manager import Manager
 from rallies import console
 from rallies.config import get_llm_provider, set_llm_provider, CONFIG_DIR
-from prompt_toolkit import PromptSession
-from prompt_toolkit.history import FileHistory
+from rallies.sessions import SessionJournal, SessionIndex, new_session_path, session_path, convert_legacy_session
 from pathlib import Path
 
 def display_application_banner():
@@ -37,7 +36,15 @@ def display_application_banner():
     
     console.print(full_banner)
 
-def interactive_shell(session_file=None):
+def interactive_shell(session_file=None, use_cache=True, use_daemon=True):
+    # Imported here so that non-chat subcommands never load the agent stack
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.history import FileHistory
+    from rallies.daemon import connect
+
+    # With a daemon running this process is a thin client and never loads the agent
+    client = connect() if use_daemon else None
+
     display_application_banner()
     
     console.print("\n[dim white]Tips for getting started:[/dim white]")
@@ -46,8 +53,9 @@ def interactive_shell(session_file=None):
     console.print("[white]3. Type /provider <openai|gemini> to switch LLM provider.[/white]")
     console.print("[white]4. Type /help for more information.[/white]\n")
     
-    selected_agent = Manager()
-    llm_provider = get_llm_provider().capitalize()
+    if client is None:
+        from rallies.manager import Manager
+        selected_agent = Manager(use_cache=use_cache)
 
     history_file = Path(CONFIG_DIR) / "history.txt"
     history_file.parent.mkdir(parents=True, exist_ok=True)
@@ -55,12 +63,12 @@ def interactive_shell(session_file=None):
 
     messages = []
     session_subject = None
+    journal = None
     if session_file and session_file.exists():
         try:
-            with open(session_file, "r") as f:
-                data = json.load(f)
-                messages = data.get("messages", [])
-                session_subject = data.get("subject", "Resumed Session")
+            journal, messages = SessionJournal.open(session_file)
+            session_file = journal.path
+            session_subject = journal.subject or "Resumed Session"
             console.print(f"[bold green]Resumed session: {session_file.name}[/bold green]")
             console.print(f"[bold]Subject: [i]{session_subject}[/i][/bold]")
             for message in messages:
@@ -73,15 +81,30 @@ def interactive_shell(session_file=None):
             messages = []
 
     if not session_file:
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        session_file = Path(CONFIG_DIR) / f"session_{timestamp}.json"
+        session_file = new_session_path()
+    if journal is None:
+        journal = SessionJournal(session_file)
 
     print("\nType your queries below. Press Ctrl+C to exit.\n")
     
+    try:
+        if client is not None:
+            remote_shell_loop(client, session, messages, journal, session_subject)
+        else:
+            asyncio.run(shell_loop(selected_agent, session, messages, journal, session_subject))
+    except (KeyboardInterrupt, EOFError):
+        print("\n\nGoodbye!")
+        sys.exit(0)
+
+async def shell_loop(selected_agent, session, messages, journal, session_subject):
+    """Read and answer queries on one event loop, shared by every turn of the session"""
+    from rallies.manager import Manager
+
+    llm_provider = get_llm_provider().capitalize()
     try:
         while True:
             prompt_text = f"({llm_provider}) > "
-            user_input_text = session.prompt(prompt_text)
+            user_input_text = await session.prompt_async(prompt_text)
 
             if user_input_text.strip().startswith("/"):
                 parts = user_input_text.strip().split()
@@ -92,87 +115,236 @@ def interactive_shell(session_file=None):
                         if provider in ["openai", "gemini"]:
                             set_llm_provider(provider)
                             llm_provider = get_llm_provider().capitalize()
-                            selected_agent = Manager()
+                            await selected_agent.agent.close_async()
+                            selected_agent = Manager(use_cache=selected_agent.agent.use_cache)
                             console.print(f"[green]LLM provider switched to: {llm_provider}[/green]\n")
                         else:
                             console.print(f"[red]Invalid provider: {provider}. Please use 'openai' or 'gemini'.[/red]\n")
                     else:
                         console.print("[red]Usage: /provider <openai|gemini>[/red]\n")
-                else:
+                elif not await selected_agent.handle_command_async(user_input_text, messages, console):
                     console.print(f"[red]Unknown command: {command}[/red]\n")
                 continue
             
             if user_input_text.strip():
                 if not session_subject:
                     session_subject = (user_input_text[:70] + '...') if len(user_input_text) > 70 else user_input_text
-                    console.print(f"[bold green]Started new session: {session_file.name}[/bold green]")
+                    console.print(f"[bold green]Started new session: {journal.path.name}[/bold green]")
                     console.print(f"[bold]Subject: [i]{session_subject}[/i][/bold]")
 
                 messages.append({"role": "user", "content": user_input_text})
-                response = selected_agent.process_prompt(user_input_text, messages)
+                response = await selected_agent.process_prompt_async(user_input_text, messages)
                 messages.append({"role": "agent", "content": response})
                 
-                session_data = {"subject": session_subject, "messages": messages}
-                with open(session_file, "w") as f:
-                    json.dump(session_data, f, indent=2)
+                journal.sync(messages, session_subject)
             else:
                 console.print("[yellow]Please enter a query.[/yellow]\n")
-                
-    except (KeyboardInterrupt, EOFError):
-        print("\n\nGoodbye!")
-        sys.exit(0)
+    finally:
+        await selected_agent.agent.close_async()
+
+def merge_conversation(messages, updated):
+    """Update messages in place to updated, keeping the message objects that did not change"""
+    unchanged = 0
+    for old, new in zip(messages, updated):
+        if old != new:
+            break
+        unchanged += 1
+    messages[unchanged:] = updated[unchanged:]
+
+def remote_shell_loop(client, session, messages, journal, session_subject):
+    """shell_loop for a thin client, turns and commands run in the daemon"""
+    from rallies.daemon import DaemonError
+
+    llm_provider = get_llm_provider().capitalize()
+    while True:
+        user_input_text = session.prompt(f"({llm_provider}) > ")
+        try:
+            if user_input_text.strip().startswith("/"):
+                parts = user_input_text.strip().split()
+                command = parts[0]
+                if command in ["/exit", "/quit"]:
+                    print("\nGoodbye!")
+                    return
+                if command == "/provider":
+                    # The daemon switches to the configured provider before its next turn
+                    if len(parts) == 2 and parts[1].lower() in ["openai", "gemini"]:
+                        set_llm_provider(parts[1].lower())
+                        llm_provider = get_llm_provider().capitalize()
+                        console.print(f"[green]LLM provider switched to: {llm_provider}[/green]\n")
+                    else:
+                        console.print("[red]Usage: /provider <openai|gemini>[/red]\n")
+                    continue
+                handled, conversation = client.command(user_input_text, messages, journal.path.name)
+                merge_conversation(messages, conversation)
+                if not handled:
+                    console.print(f"[red]Unknown command: {command}[/red]\n")
+                continue
+
+            if user_input_text.strip():
+                if not session_subject:
+                    session_subject = (user_input_text[:70] + '...') if len(user_input_text) > 70 else user_input_text
+                    console.print(f"[bold green]Started new session: {journal.path.name}[/bold green]")
+                    console.print(f"[bold]Subject: [i]{session_subject}[/i][/bold]")
+
+                messages.append({"role": "user", "content": user_input_text})
+                response, conversation = client.prompt(user_input_text, messages, journal.path.name)
+                merge_conversation(messages, conversation)
+                messages.append({"role": "agent", "content": response})
+
+                journal.sync(messages, session_subject)
+            else:
+                console.print("[yellow]Please enter a query.[/yellow]\n")
+        except DaemonError as e:
+            console.print(f"[red]⚠ {e}. Start it again with `rallies daemon start`, or run `rallies --no-daemon`.[/red]\n")
+
+def run_daemon_command(args):
+    from rallies import daemon
+
+    try:
+        idle_timeout = pop_option(args, "--idle-timeout")
+        idle_timeout = float(idle_timeout) if idle_timeout is not None else None
+    except ValueError:
+        console.print("[red]--idle-timeout must be a number of seconds[/red]")
+        sys.exit(2)
+    action = args[0] if args else "run"
+    if not daemon.SUPPORTED:
+        console.print(f"[yellow]{daemon.UNSUPPORTED_MESSAGE}[/yellow]")
+        sys.exit(1)
+
+    if action == "run":
+        sys.exit(daemon.run(idle_timeout=idle_timeout))
+    client = daemon.connect()
+    if action == "start":
+        if client is not None:
+            console.print("[yellow]The rallies daemon is already running.[/yellow]")
+        elif daemon.start_background(idle_timeout=idle_timeout) is not None:
+            console.print("[green]Started the rallies daemon.[/green]")
+        else:
+            console.print(f"[red]The daemon did not start, see {Path(CONFIG_DIR) / 'daemon.log'}[/red]")
+            sys.exit(1)
+    elif action == "stop":
+        if client is None:
+            console.print("[yellow]The rallies daemon is not running.[/yellow]")
+        else:
+            client.shutdown()
+            console.print("[green]Stopped the rallies daemon.[/green]")
+    elif action == "status":
+        if client is None:
+            console.print("[yellow]The rallies daemon is not running.[/yellow]")
+        else:
+            status = client.status()
+            console.print(
+                f"[green]The rallies daemon is running[/green] (pid {status['pid']}, up {status['uptime']:.0f}s, "
+                f"idle {status['idle']:.0f}s, {status['turns']} turns, provider {status['provider']})"
+            )
+    else:
+        console.print("[red]Usage: rallies daemon [run|start|stop|status] [--idle-timeout SECONDS][/red]")
+        sys.exit(2)
+
+def get_sessions():
+    return SessionIndex().sessions()
 
 def get_session_files():
-    return sorted(glob.glob(str(Path(CONFIG_DIR) / "session_*.json")), key=os.path.getmtime, reverse=True)
+    return [session["path"] for session in get_sessions()]
+
+def pop_option(args, name, default=None):
+    """Remove `name value` from args and return the value"""
+    if name in args:
+        index = args.index(name)
+        if index + 1 < len(args):
+            value = args[index + 1]
+            del args[index:index + 2]
+            return value
+        del args[index]
+    return default
+
+def run_headless(command, args, use_cache, use_daemon=True):
+    from rallies.batch import read_questions, run_batch
+    from rallies.daemon import connect, DaemonError
+
+    try:
+        workers = int(pop_option(args, "--workers", 4))
+    except ValueError:
+        console.print("[red]--workers must be a number[/red]")
+        sys.exit(2)
+    output_path = pop_option(args, "--output")
+
+    if command == "ask" and args:
+        questions = [" ".join(args)]
+    else:
+        source = args[0] if args else None
+        try:
+            questions = read_questions(source)
+        except OSError as e:
+            console.print(f"[red]Could not read questions: {e}[/red]")
+            sys.exit(2)
+    if not questions:
+        console.print(f"[red]Usage: rallies {command} {'QUESTION' if command == 'ask' else 'FILE'} [--workers N] [--output FILE][/red]")
+        sys.exit(2)
+
+    output = open(output_path, "w") if output_path else None
+    client = connect() if use_daemon and command == "ask" else None
+    try:
+        if client is not None:
+            try:
+                failures = client.batch(questions, workers=workers, output=output)
+            except DaemonError as e:
+                console.print(f"[red]⚠ {e}[/red]")
+                failures = len(questions)
+        else:
+            failures = run_batch(questions, workers=workers, output=output, use_cache=use_cache)
+    finally:
+        if output:
+            output.close()
+    sys.exit(1 if failures else 0)
 
 def main():
     args = sys.argv[1:]
+
+    # --no-cache bypasses the data cache for this run, the daemon shares its cache
+    # between clients so such runs stay in process, as do --no-daemon runs
+    use_cache = "--no-cache" not in args
+    use_daemon = use_cache and "--no-daemon" not in args
+    args = [arg for arg in args if arg not in ["--no-cache", "--no-daemon"]]
     
     if "--continue" in args:
         session_files = get_session_files()
         if session_files:
-            interactive_shell(session_file=Path(session_files[0]))
+            interactive_shell(session_file=Path(session_files[0]), use_cache=use_cache, use_daemon=use_daemon)
         else:
             console.print("[yellow]No sessions found to continue.[/yellow]")
-            interactive_shell()
+            interactive_shell(use_cache=use_cache, use_daemon=use_daemon)
         return
 
     if "--resume" in args:
         resume_index = args.index("--resume")
         session_id = args[resume_index + 1] if len(args) > resume_index + 1 and not args[resume_index + 1].startswith("-") else None
 
-        session_files = get_session_files()
-        if not session_files:
+        sessions = get_sessions()
+        if not sessions:
             console.print("[yellow]No sessions found to resume.[/yellow]")
-            interactive_shell()
+            interactive_shell(use_cache=use_cache, use_daemon=use_daemon)
             return
 
         if session_id:
-            target_file = Path(CONFIG_DIR) / f"session_{session_id}.json"
+            target_file = session_path(session_id)
             if target_file.exists():
-                interactive_shell(session_file=target_file)
+                interactive_shell(session_file=target_file, use_cache=use_cache, use_daemon=use_daemon)
             else:
                 console.print(f"[red]Session '{session_id}' not found.[/red]")
         else:
             console.print("[bold]Available sessions to resume:[/bold]")
-            for i, f_path_str in enumerate(session_files):
-                f_path = Path(f_path_str)
-                subject = "No subject"
-                try:
-                    with open(f_path, 'r') as sf:
-                        data = json.load(sf)
-                        subject = data.get("subject", "No subject")
-                except (json.JSONDecodeError, FileNotFoundError):
-                    subject = "[red]Error reading session[/red]"
-                console.print(f"  [cyan]{i + 1}[/cyan]: {f_path.name} - [i]{subject}[/i]")
+            for i, entry in enumerate(sessions):
+                subject = entry.get("subject") or "No subject"
+                console.print(f"  [cyan]{i + 1}[/cyan]: {Path(entry['path']).name} - [i]{subject}[/i] [dim]({entry.get('messages', 0)} messages)[/dim]")
             
             try:
                 choice_str = input("Choose a session number (or press Enter to cancel): ")
                 if not choice_str:
                     sys.exit(0)
                 choice = int(choice_str) - 1
-                if 0 <= choice < len(session_files):
-                    interactive_shell(session_file=Path(session_files[choice]))
+                if 0 <= choice < len(sessions):
+                    interactive_shell(session_file=Path(sessions[choice]["path"]), use_cache=use_cache, use_daemon=use_daemon)
                 else:
                     console.print("[red]Invalid selection.[/red]")
             except ValueError:
@@ -181,7 +353,27 @@ def main():
 
     if args:
         command = args[0]
-        if command == "provider":
+        if command in ["ask", "batch"]:
+            run_headless(command, args[1:], use_cache, use_daemon)
+        elif command == "daemon":
+            run_daemon_command(args[1:])
+        elif command == "serve":
+            from rallies.server import run
+            sys.exit(run(args[1:], use_cache=use_cache))
+        elif command == "sessions":
+            if len(args) > 1 and args[1] == "convert":
+                legacy_files = glob.glob(str(Path(CONFIG_DIR) / "session_*.json"))
+                for legacy_file in legacy_files:
+                    try:
+                        converted = convert_legacy_session(legacy_file)
+                        console.print(f"[green]Converted {Path(legacy_file).name} -> {converted.name}[/green]")
+                    except (json.JSONDecodeError, OSError) as e:
+                        console.print(f"[red]Could not convert {Path(legacy_file).name}: {e}[/red]")
+                if not legacy_files:
+                    console.print("[yellow]No legacy sessions to convert.[/yellow]")
+            else:
+                console.print("[red]Usage: rallies sessions convert[/red]")
+        elif command == "provider":
             if len(args) > 2 and args[1] == "set":
                 provider = args[2].lower()
                 if provider in ["openai", "gemini"]:
@@ -194,7 +386,7 @@ def main():
         else:
             console.print(f"[red]Unknown command: {command}[/red]")
     else:
-        interactive_shell()
+        interactive_shell(use_cache=use_cache, use_daemon=use_daemon)
 
 if __name__ == '__main__':
     main()
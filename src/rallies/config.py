@@ -1,32 +1,407 @@
 import os
+import copy
 import json
+import tempfile
+import threading
+import contextvars
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, writes are still atomic but not serialized across processes
+    fcntl = None
 
 CONFIG_DIR = os.path.expanduser("~/.rallies")
 CONFIG_FILE = os.path.join(CONFIG_DIR, "config.json")
 
-def get_config():
-    """Reads the configuration file."""
-    if not os.path.exists(CONFIG_FILE):
-        return {}
+# Types of the settings, a value of another type is ignored when read and refused when
+# written. Every getter reads its settings through store.get, which applies these.
+SCHEMA = {
+    "llm_provider": str,
+    "api_key": str,
+    "api_url": str,
+    "gemini_api_url": str,
+    "models": dict,
+    "model_timeouts": dict,
+    "max_parallel_steps": int,
+    "http_pool_connections": int,
+    "http_pool_maxsize": int,
+    "cache_enabled": bool,
+    "cache_ttl": int,
+    "cache_max_entries": int,
+    "context_budget": int,
+    "context_keep_recent_data": int,
+    "context_stale_data_chars": int,
+    "context_compact_threshold": int,
+    "context_auto_compact": bool,
+    "summary_mode": str,
+    "stream_planner": bool,
+    "tables_enabled": bool,
+    "tables_min_rows": int,
+    "tables_max_tables": int,
+    "tables_sample_rows": int,
+    "tracing_enabled": bool,
+    "trace_otlp_endpoint": str,
+    "trace_max_bytes": int,
+    "prefetch_enabled": bool,
+    "prefetch_max_requests": int,
+    "daemon_socket": str,
+    "daemon_idle_timeout": float,
+    "serve_host": str,
+    "serve_port": int,
+    "serve_max_inflight": int,
+    "serve_max_sessions": int,
+    "serve_token": str,
+}
+PROVIDERS = ["openai", "gemini"]
+SUMMARY_MODES = ["step", "pipelined", "batch"]
+# Flags edited into the file by hand as strings
+FLAG_STRINGS = {"true": True, "false": False, "yes": True, "no": False, "on": True, "off": False, "1": True, "0": False}
+
+
+class ConfigStore:
+    """The config file, parsed once per process and read again only when it changes
+
+    Reads check the file's mtime, size and inode with one stat. Writes hold an exclusive
+    lock on a sidecar lock file, apply their changes to what is on disk at that moment and
+    replace the file with a renamed temporary file, so concurrent CLI and daemon processes
+    neither lose each other's keys nor see a half written file.
+    """
+
+    def __init__(self, path=CONFIG_FILE):
+        self.path = path
+        self._data = {}
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def _load(self):
+        signature = self._stat()
+        if signature == self._signature:
+            return self._data
+        data = {}
+        if signature is not None:
+            try:
+                with open(self.path, "r") as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                pass
+        self._data = data if isinstance(data, dict) else {}
+        self._signature = signature
+        return self._data
+
+    def read(self):
+        """The cached config, shared with every other caller so it must not be changed"""
+        with self._lock:
+            return self._load()
+
+    def get(self, key, default=None):
+        """A value of the config as its schema type, the default when it is missing or invalid"""
+        value = self.read().get(key)
+        if value is None:
+            return default
+        expected = SCHEMA.get(key)
+        if expected is None:
+            return value
+        try:
+            return coerce(value, expected)
+        except (TypeError, ValueError):
+            return default
+
+    def update(self, change):
+        """Apply change(config) to the latest config on disk and write it atomically"""
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".lock", "a") as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    current = self._load()
+                    config = copy.deepcopy(current)
+                    change(config)
+                    validate(config, current)
+                    self._write(config)
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(lock, fcntl.LOCK_UN)
+            return config
+
+    def _write(self, config):
+        fd, temporary = tempfile.mkstemp(prefix=".config.", dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(config, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
+            raise
+        self._data = config
+        self._signature = self._stat()
+
+
+def coerce(value, expected):
+    """The value as the expected type, raises ValueError when it is not one
+
+    Numbers may be written as strings and flags as 0 or 1, as older configs did, or as
+    strings such as "false".
+    """
+    if expected is bool:
+        if isinstance(value, bool) or value in (0, 1):
+            return bool(value)
+        if isinstance(value, str) and value.strip().lower() in FLAG_STRINGS:
+            return FLAG_STRINGS[value.strip().lower()]
+    elif expected in (int, float):
+        # bool is an int in Python but not a valid cache_ttl
+        if not isinstance(value, (bool, dict, list)):
+            return expected(value)
+    elif isinstance(value, expected):
+        return value
+    raise ValueError(f"expected a {expected.__name__}, not {type(value).__name__}")
+
+
+def validate(config, previous=None):
+    """Raises ValueError when a changed setting of the schema has the wrong type
+
+    Settings that are as they were are left alone, so that a bad value edited into the
+    file by hand does not block every later write.
+    """
+    previous = previous or {}
+    changed = {key for key in SCHEMA if config.get(key) != previous.get(key)}
+    for key in changed:
+        value = config.get(key)
+        if value is not None:
+            try:
+                coerce(value, SCHEMA[key])
+            except (TypeError, ValueError) as e:
+                raise ValueError(f"{key}: {e}")
+    if "llm_provider" in changed and config.get("llm_provider") not in (None, *PROVIDERS):
+        raise ValueError(f"llm_provider must be one of {', '.join(PROVIDERS)}")
+    if "summary_mode" in changed and config.get("summary_mode") not in (None, *SUMMARY_MODES):
+        raise ValueError(f"summary_mode must be one of {', '.join(SUMMARY_MODES)}")
+    if "models" in changed:
+        for provider, stages in (config.get("models") or {}).items():
+            if not isinstance(stages, dict):
+                raise ValueError(f"models.{provider} must map stages to models")
+
+
+store = ConfigStore()
+
+# The environment of the client a daemon request runs for, None outside of one
+_request_env = contextvars.ContextVar("rallies_request_env", default=None)
+
+@contextmanager
+def request_env(values):
+    """Read the LLM keys and provider from `values` instead of os.environ in this context."""
+    token = _request_env.set(dict(values))
     try:
-        with open(CONFIG_FILE, "r") as f:
-            return json.load(f)
-    except json.JSONDecodeError:
-        return {}
+        yield
+    finally:
+        _request_env.reset(token)
+
+def get_env(name):
+    """Gets an environment variable of the client the current request runs for."""
+    values = _request_env.get()
+    return os.getenv(name) if values is None else values.get(name)
+
+def in_request():
+    """Whether the current context runs a daemon request, see request_env."""
+    return _request_env.get() is not None
+
+def llm_key_name(provider):
+    """The environment variable that holds the API key of an LLM provider."""
+    return "GEMINI_API_KEY" if provider == "gemini" else "OPENAI_API_KEY"
+
+
+class MissingKeyError(Exception):
+    """The client a request runs for has not set the key of its LLM provider"""
+
+def get_config():
+    """Reads the configuration file, a copy that the caller may change and pass to save_config."""
+    return copy.deepcopy(store.read())
 
 def save_config(config):
-    """Saves the configuration file."""
-    os.makedirs(CONFIG_DIR, exist_ok=True)
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(config, f, indent=4)
+    """Saves the configuration file, replacing it as a whole."""
+    def change(current):
+        current.clear()
+        current.update(config)
+    store.update(change)
+
+def update_config(**values):
+    """Sets some keys of the configuration file, a value of None removes its key."""
+    def change(config):
+        for key, value in values.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+    return store.update(change)
 
 def get_llm_provider():
     """Gets the LLM provider from the config file."""
-    config = get_config()
-    return config.get("llm_provider", "openai")
+    provider = store.get("llm_provider", "openai")
+    return provider if provider in PROVIDERS else "openai"
 
 def set_llm_provider(provider: str):
     """Sets the LLM provider in the config file."""
-    config = get_config()
-    config["llm_provider"] = provider
-    save_config(config)
+    update_config(llm_provider=provider)
+
+def get_max_parallel_steps():
+    """Gets how many plan steps may run at once from the config file."""
+    return max(1, store.get("max_parallel_steps", 4))
+
+def get_http_pool_limits():
+    """Gets the connection pool limits for rallies.ai requests from the config file."""
+    connections = max(1, store.get("http_pool_connections", 2))
+    maxsize = max(1, store.get("http_pool_maxsize", 10))
+    return connections, maxsize
+
+def get_cache_settings():
+    """Gets the action result cache settings from the config file."""
+    settings = {"enabled": True, "ttl": 900, "max_entries": 256}
+    settings["enabled"] = store.get("cache_enabled", True)
+    settings["ttl"] = max(0, store.get("cache_ttl", 900))
+    settings["max_entries"] = max(1, store.get("cache_max_entries", 256))
+    return settings
+
+def get_context_settings():
+    """Gets the token budget and compaction settings for LLM calls from the config file."""
+    settings = {
+        "budget": 120000,
+        "keep_recent_data": 8,
+        "stale_data_chars": 2000,
+        "compact_threshold": 80000,
+        "auto_compact": True,
+    }
+    for key in ["budget", "keep_recent_data", "stale_data_chars", "compact_threshold"]:
+        settings[key] = max(0, store.get(f"context_{key}", settings[key]))
+    settings["auto_compact"] = store.get("context_auto_compact", True)
+    return settings
+
+def get_summary_mode():
+    """Gets how plan step summaries are scheduled from the config file."""
+    mode = store.get("summary_mode", "pipelined")
+    return mode if mode in SUMMARY_MODES else "pipelined"
+
+def get_stream_planner():
+    """Gets whether plan steps are dispatched while the planner is still streaming."""
+    return store.get("stream_planner", True)
+
+def get_table_settings():
+    """Gets how tabular action results are compacted from the config file."""
+    settings = {"enabled": True, "min_rows": 20, "max_tables": 50, "sample_rows": 3}
+    settings["enabled"] = store.get("tables_enabled", True)
+    for key in ["min_rows", "max_tables", "sample_rows"]:
+        settings[key] = max(0, store.get(f"tables_{key}", settings[key]))
+    return settings
+
+def get_api_url():
+    """Gets the rallies.ai base URL, RALLIES_API_URL overrides the config file."""
+    url = os.getenv("RALLIES_API_URL") or store.get("api_url") or "https://rallies.ai"
+    return url.rstrip("/")
+
+def get_gemini_api_url():
+    """Gets a custom Gemini endpoint from GEMINI_API_URL, None for Google's own."""
+    return os.getenv("GEMINI_API_URL") or store.get("gemini_api_url")
+
+def get_trace_settings():
+    """Gets the tracing settings, RALLIES_OTLP_ENDPOINT overrides the config file."""
+    settings = {"enabled": True, "otlp_endpoint": None, "max_bytes": 10 * 1024 * 1024}
+    settings["enabled"] = store.get("tracing_enabled", True)
+    settings["otlp_endpoint"] = os.getenv("RALLIES_OTLP_ENDPOINT") or store.get("trace_otlp_endpoint")
+    settings["max_bytes"] = max(0, store.get("trace_max_bytes", settings["max_bytes"]))
+    return settings
+
+MODEL_STAGES = ["planner", "summarizer", "compactor", "answerer"]
+
+# Primary model first, then the fallbacks tried when it errors or is slow. The
+# planner and summarizer run several times per turn so they default to fast models.
+DEFAULT_MODELS = {
+    "openai": {
+        "planner": ["gpt-4.1-mini", "gpt-4.1"],
+        "summarizer": ["gpt-4.1-nano", "gpt-4.1-mini"],
+        "compactor": ["gpt-4.1-mini", "gpt-4.1"],
+        "answerer": ["gpt-4.1", "gpt-4.1-mini"],
+    },
+    "gemini": {
+        "planner": ["gemini-2.5-flash", "gemini-2.5-pro"],
+        "summarizer": ["gemini-2.5-flash-lite", "gemini-2.5-flash"],
+        "compactor": ["gemini-2.5-flash", "gemini-2.5-pro"],
+        "answerer": ["gemini-2.5-pro", "gemini-2.5-flash"],
+    },
+}
+
+# Seconds a model may take to respond (to its first chunk when streaming)
+# before the next model in the chain is tried
+DEFAULT_MODEL_TIMEOUTS = {"planner": 20, "summarizer": 15, "compactor": 60, "answerer": 45}
+
+def get_stage_models(provider=None):
+    """Gets the model chain of every stage for a provider from the config file."""
+    provider = provider or get_llm_provider()
+    configured = store.get("models", {}).get(provider)
+    if not isinstance(configured, dict):
+        configured = {}
+    models = {}
+    for stage in MODEL_STAGES:
+        chain = configured.get(stage)
+        if isinstance(chain, str):
+            chain = [chain]
+        if not isinstance(chain, list) or not chain:
+            chain = DEFAULT_MODELS.get(provider, DEFAULT_MODELS["openai"])[stage]
+        models[stage] = [str(model) for model in chain]
+    return models
+
+def set_stage_models(stage, models, provider=None):
+    """Sets the model chain of a stage in the config file, None restores the default."""
+    provider = provider or get_llm_provider()
+
+    def change(config):
+        configured = config.setdefault("models", {}).setdefault(provider, {})
+        if models:
+            configured[stage] = list(models)
+        else:
+            configured.pop(stage, None)
+    store.update(change)
+
+def get_model_timeouts():
+    """Gets the per-stage fallback timeouts in seconds from the config file."""
+    configured = store.get("model_timeouts", {})
+    timeouts = dict(DEFAULT_MODEL_TIMEOUTS)
+    for stage in MODEL_STAGES:
+        try:
+            timeouts[stage] = max(0, coerce(configured.get(stage, timeouts[stage]), float))
+        except (TypeError, ValueError):
+            pass
+    return timeouts
+
+def get_prefetch_settings():
+    """Gets the speculative prefetch settings from the config file."""
+    return {
+        "enabled": store.get("prefetch_enabled", False),
+        "max_requests": max(0, store.get("prefetch_max_requests", 3)),
+    }
+
+def get_daemon_settings():
+    """Gets the daemon socket path and idle timeout, RALLIES_DAEMON_SOCKET overrides the path."""
+    return {
+        "socket": os.getenv("RALLIES_DAEMON_SOCKET") or store.get("daemon_socket") or os.path.join(CONFIG_DIR, "daemon.sock"),
+        "idle_timeout": max(0, store.get("daemon_idle_timeout", 1800)),
+    }
+
+def get_serve_settings():
+    """Gets the `rallies serve` address, in-flight limit and token, RALLIES_SERVE_TOKEN overrides the token."""
+    return {
+        "host": store.get("serve_host") or "127.0.0.1",
+        "port": max(1, store.get("serve_port", 8700)),
+        "max_inflight": max(1, store.get("serve_max_inflight", 8)),
+        "max_sessions": max(1, store.get("serve_max_sessions", 100)),
+        "token": os.getenv("RALLIES_SERVE_TOKEN") or store.get("serve_token"),
+    }
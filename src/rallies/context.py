@@ -0,0 +1,81 @@
+class ContextManager:
+    """Keeps the conversation sent with each LLM call under a token budget
+
+    Raw data payloads are the bulk of every prompt. When a call would exceed the budget,
+    older payloads are truncated and then dropped first, the most recent step results
+    last, and only then the oldest messages themselves.
+    """
+
+    def __init__(self, token_counter, budget=120000, keep_recent_data=8, stale_data_chars=2000):
+        self.token_counter = token_counter
+        self.budget = budget
+        self.keep_recent_data = keep_recent_data
+        self.stale_data_chars = stale_data_chars
+
+    def truncate(self, message):
+        content = str(message.get("content", ""))
+        if len(content) <= self.stale_data_chars:
+            return message
+        truncated = dict(message, truncated=True)
+        truncated["content"] = (
+            content[:self.stale_data_chars]
+            + f"\n... [truncated {len(content) - self.stale_data_chars} characters]"
+        )
+        return truncated
+
+    def fit(self, messages):
+        """Return the messages, pruned to fit the budget when needed"""
+        counts = [self.token_counter.count_message_tokens(message) for message in messages]
+        total = sum(counts)
+        if not self.budget or total <= self.budget:
+            return messages
+
+        fitted = list(messages)
+        data = [i for i, message in enumerate(fitted) if _is_data(message)]
+        keep = min(self.keep_recent_data, len(data))
+        stale, recent = data[:len(data) - keep], data[len(data) - keep:]
+
+        def replace(index, message):
+            nonlocal total
+            count = self.token_counter.count_message_tokens(message) if message is not None else 0
+            total += count - counts[index]
+            counts[index] = count
+            fitted[index] = message
+
+        # Truncate, then drop, stale payloads, then truncate the recent ones, oldest first
+        for index in stale:
+            if total <= self.budget:
+                return [message for message in fitted if message is not None]
+            replace(index, self.truncate(fitted[index]))
+        for index in stale:
+            if total <= self.budget:
+                return [message for message in fitted if message is not None]
+            replace(index, None)
+        for index in recent:
+            if total <= self.budget:
+                return [message for message in fitted if message is not None]
+            replace(index, self.truncate(fitted[index]))
+
+        # Finally drop the oldest messages, always keeping the latest one
+        for index in range(len(fitted) - 1):
+            if total <= self.budget:
+                break
+            if fitted[index] is not None:
+                replace(index, None)
+        return [message for message in fitted if message is not None]
+
+    def prune(self, conversation, start=0):
+        """Truncate the data payloads appended from `start` on, in place, once they are stale"""
+        for index in range(start, len(conversation)):
+            message = conversation[index]
+            if not _is_data(message):
+                continue
+            if self.stale_data_chars:
+                conversation[index] = self.truncate(message)
+            else:
+                conversation[index] = None
+        conversation[start:] = [message for message in conversation[start:] if message is not None]
+
+
+def _is_data(message):
+    return isinstance(message, dict) and message.get("type") == "data"
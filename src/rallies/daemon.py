@@ -0,0 +1,445 @@
+"""Background daemon that keeps a warm Manager, and the thin client that talks to it
+
+The daemon listens on a Unix socket. Every request is one connection carrying one
+JSON line, the daemon answers with JSON lines: "output" frames with rendered terminal
+output, then a final "done" or "error" frame. Closing the connection cancels the request.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from .config import get_daemon_settings, request_env, get_env, llm_key_name
+from .tracing import tracer
+
+# Environment the client passes on, so that turns use the keys of the shell asking
+FORWARDED_ENV = ("OPENAI_API_KEY", "GEMINI_API_KEY", "RALLIES")
+# The daemon needs Unix sockets, which Python does not have on Windows
+SUPPORTED = hasattr(socket, "AF_UNIX")
+UNSUPPORTED_MESSAGE = "The rallies daemon needs Unix sockets, which this platform does not have. rallies runs in process instead."
+
+
+class DaemonError(Exception):
+    """The daemon could not be reached or failed a request"""
+
+
+class ConnectionOutput:
+    """File-like object that queues Rich output for a connection
+
+    Rich Live refreshes from its own thread, so writes are handed to the loop.
+    """
+
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+
+    def write(self, text):
+        if text:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, {"type": "output", "data": text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return True
+
+
+class Daemon:
+    """Answers thin clients on a Unix socket with one warm Manager
+
+    The Manager, and with it the LLM clients, the HTTP pool, the tokenizer and the data
+    cache, lives as long as the daemon. It stops after `idle_timeout` seconds without
+    requests, 0 keeps it running.
+    """
+
+    def __init__(self, path, idle_timeout=1800):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.manager = None
+        self.provider = None
+        # Requests using each Manager, one replaced by a provider switch is closed after its last request
+        self.holders = Counter()
+        self.started = time.time()
+        self.last_active = time.time()
+        self.active = 0
+        self.turns = 0
+        self.conversations = OrderedDict()
+        self._manager_lock = None
+        self._stopping = None
+
+    async def get_manager(self):
+        """The warm Manager, rebuilt when the provider was switched since it was made"""
+        from .config import get_llm_provider
+        from .manager import Manager
+
+        async with self._manager_lock:
+            provider = get_llm_provider()
+            if self.manager is not None and provider != self.provider:
+                old, self.manager = self.manager, None
+                # Requests of other clients may still be using it, the last of them closes it
+                if not self.holders[old]:
+                    self.holders.pop(old, None)
+                    await old.agent.close_async()
+            if self.manager is None:
+                self.manager = Manager(concurrent_turns=4)
+                self.provider = provider
+            return self.manager
+
+    @asynccontextmanager
+    async def hold_manager(self):
+        """The warm Manager for one request, kept open until the request is done with it"""
+        manager = await self.get_manager()
+        self.holders[manager] += 1
+        try:
+            yield manager
+        finally:
+            self.holders[manager] -= 1
+            if manager is not self.manager and not self.holders[manager]:
+                del self.holders[manager]
+                await manager.agent.close_async()
+
+    async def warm(self):
+        """Pay for imports, the tokenizer and the clients before the first request does"""
+        from .helpers import get_encoding
+
+        manager = await self.get_manager()
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, get_encoding)
+            manager.agent.async_session
+            manager.agent.llm.async_client
+        except Exception:
+            # Missing keys or no network, the first turn reports it
+            pass
+
+    def conversation(self, session, messages):
+        """The daemon's copy of a session's conversation
+
+        It is reused while the client's copy still matches it, so that a background
+        compaction started by the last turn can be applied to it.
+        """
+        known = self.conversations.get(session)
+        if known is not None and known == messages:
+            self.conversations.move_to_end(session)
+            return known
+        conversation = list(messages)
+        if session:
+            self.conversations[session] = conversation
+            while len(self.conversations) > 32:
+                self.conversations.popitem(last=False)
+        return conversation
+
+    def terminal(self, request, output):
+        from rich.console import Console
+
+        terminal = bool(request.get("terminal", True))
+        return Console(
+            file=output,
+            width=request.get("width") or 100,
+            color_system=request.get("color_system") if terminal else None,
+            force_terminal=terminal,
+            force_interactive=terminal,
+        )
+
+    async def dispatch(self, request, output):
+        kind = request.get("type")
+        if kind == "status":
+            return {
+                "type": "done",
+                "pid": os.getpid(),
+                "uptime": round(time.time() - self.started, 1),
+                "idle": round(time.time() - self.last_active, 1),
+                "turns": self.turns,
+                "clients": self.active - 1,
+                "provider": self.provider,
+            }
+        if kind == "shutdown":
+            # The daemon stops once this reply is sent, see handle
+            return {"type": "done"}
+
+        # Turns use the keys of the client asking, never those of another client
+        env = {key: value for key, value in (request.get("env") or {}).items() if key in FORWARDED_ENV and value}
+        with request_env(env):
+            async with self.hold_manager() as manager:
+                return await self.run_request(kind, request, output, manager)
+
+    async def run_request(self, kind, request, output, manager):
+        from .manager import check_llm_key
+
+        # Checked once before any work, for commands such as /compact and batches too
+        provider = manager.agent.llm.llm_provider
+        if not get_env(llm_key_name(provider)):
+            if kind == "batch":
+                raise DaemonError(f"{llm_key_name(provider)} is not set")
+            check_llm_key(self.terminal(request, output), provider)
+            return {"type": "done", "answer": "", "handled": True, "conversation": request.get("conversation") or []}
+
+        if kind == "prompt":
+            conversation = self.conversation(request.get("session"), request.get("conversation") or [])
+            console = self.terminal(request, output)
+            with tracer.scope(request.get("session")):
+                answer = await manager.process_prompt_async(request["prompt"], conversation, output=console)
+            self.turns += 1
+            return {"type": "done", "answer": answer, "conversation": conversation}
+
+        if kind == "command":
+            prompt = request["prompt"]
+            if prompt.strip() in ["/exit", "/quit"]:
+                return {"type": "done", "handled": False}
+            parts = prompt.split()
+            if parts[0] == "/export" and len(parts) > 1 and request.get("cwd"):
+                # Exported files go to the client's directory
+                path = parts[2] if len(parts) > 2 else f"table_{parts[1]}.csv"
+                prompt = f"/export {parts[1]} {os.path.join(request['cwd'], path)}"
+            conversation = self.conversation(request.get("session"), request.get("conversation") or [])
+            console = self.terminal(request, output)
+            # /stats reports on the client's session
+            with tracer.scope(request.get("session")):
+                handled = await manager.handle_command_async(prompt, conversation, console)
+            return {"type": "done", "handled": bool(handled), "conversation": conversation}
+
+        if kind == "batch":
+            from .batch import run_batch_async
+
+            failures = await run_batch_async(
+                request["questions"], workers=request.get("workers", 4), output=output, manager=manager
+            )
+            self.turns += len(request["questions"])
+            return {"type": "done", "failures": failures}
+
+        raise DaemonError(f"Unknown request: {kind}")
+
+    async def send(self, writer, queue):
+        """Write queued frames to the connection until None, consecutive output is sent as one frame"""
+        while True:
+            frames = [await queue.get()]
+            while not queue.empty():
+                frames.append(queue.get_nowait())
+            data = []
+            for frame in frames:
+                if frame is None:
+                    break
+                if frame["type"] == "output" and data and data[-1]["type"] == "output":
+                    data[-1] = {"type": "output", "data": data[-1]["data"] + frame["data"]}
+                else:
+                    data.append(frame)
+            writer.write("".join(json.dumps(frame) + "\n" for frame in data).encode("utf-8"))
+            await writer.drain()
+            if frame is None:
+                return
+
+    async def handle(self, reader, writer):
+        self.active += 1
+        self.last_active = time.time()
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        sender = asyncio.ensure_future(self.send(writer, queue))
+        work = closed = request = None
+        try:
+            request = json.loads(await reader.readline() or b"{}")
+            work = asyncio.ensure_future(self.dispatch(request, ConnectionOutput(loop, queue)))
+            # The client hanging up, such as on Ctrl+C, cancels its request
+            closed = asyncio.ensure_future(reader.read())
+            await asyncio.wait({work, closed}, return_when=asyncio.FIRST_COMPLETED)
+            if work.done():
+                try:
+                    reply = work.result()
+                except Exception as e:
+                    reply = {"type": "error", "message": str(e) or type(e).__name__}
+                queue.put_nowait(reply)
+                queue.put_nowait(None)
+                await sender
+        except (ValueError, ConnectionError):
+            pass
+        finally:
+            for task in (work, closed, sender):
+                if task is not None and not task.done():
+                    task.cancel()
+            writer.close()
+            self.active -= 1
+            self.last_active = time.time()
+            if isinstance(request, dict) and request.get("type") == "shutdown":
+                self._stopping.set()
+
+    async def watch_idle(self):
+        while True:
+            await asyncio.sleep(min(30, self.idle_timeout))
+            if not self.active and time.time() - self.last_active >= self.idle_timeout:
+                self._stopping.set()
+                return
+
+    async def serve(self):
+        self._manager_lock = asyncio.Lock()
+        self._stopping = asyncio.Event()
+        if os.path.exists(self.path):
+            # Left behind by a daemon that did not shut down cleanly
+            os.unlink(self.path)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(self.handle, path=self.path)
+        finally:
+            os.umask(umask)
+        watcher = asyncio.ensure_future(self.watch_idle()) if self.idle_timeout else None
+        try:
+            await self.warm()
+            await self._stopping.wait()
+        finally:
+            server.close()
+            if watcher is not None:
+                watcher.cancel()
+            if self.manager is not None:
+                await self.manager.agent.close_async()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+class DaemonClient:
+    """Forwards requests to a running daemon, one connection per request"""
+
+    def __init__(self, path=None):
+        self.path = path or get_daemon_settings()["socket"]
+
+    def connect(self):
+        if not SUPPORTED:
+            raise OSError("Unix sockets are not supported on this platform")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def running(self):
+        try:
+            self.connect().close()
+            return True
+        except OSError:
+            return False
+
+    def request(self, request, output=None):
+        """Send a request, copy its output to `output` (stdout) and return the final frame"""
+        output = output or sys.stdout
+        try:
+            sock = self.connect()
+        except OSError as e:
+            raise DaemonError(f"The daemon is not running: {e}")
+        with sock, sock.makefile("r", encoding="utf-8") as lines:
+            sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+            for line in lines:
+                frame = json.loads(line)
+                if frame["type"] == "output":
+                    output.write(frame["data"])
+                    output.flush()
+                elif frame["type"] == "error":
+                    raise DaemonError(frame["message"])
+                else:
+                    return frame
+        raise DaemonError("The daemon closed the connection")
+
+    def turn_request(self, kind, prompt, conversation, session=None):
+        from . import console
+
+        return {
+            "type": kind,
+            "prompt": prompt,
+            "conversation": conversation,
+            "session": session,
+            "width": console.width,
+            "color_system": console.color_system,
+            "terminal": console.is_terminal,
+            "cwd": os.getcwd(),
+            "env": {key: os.getenv(key) for key in FORWARDED_ENV if os.getenv(key)},
+        }
+
+    def prompt(self, prompt, conversation, session=None):
+        """Run a turn, returns (answer, the conversation after the turn)"""
+        reply = self.request(self.turn_request("prompt", prompt, conversation, session))
+        return reply["answer"], reply["conversation"]
+
+    def command(self, prompt, conversation, session=None):
+        """Run a slash command, returns (handled, the conversation after the command)"""
+        reply = self.request(self.turn_request("command", prompt, conversation, session))
+        return reply["handled"], reply.get("conversation", conversation)
+
+    def batch(self, questions, workers=4, output=None):
+        """Answer questions like `run_batch`, returns the number that failed"""
+        request = {
+            "type": "batch",
+            "questions": questions,
+            "workers": workers,
+            "env": {key: os.getenv(key) for key in FORWARDED_ENV if os.getenv(key)},
+        }
+        return self.request(request, output)["failures"]
+
+    def status(self):
+        return self.request({"type": "status"})
+
+    def shutdown(self):
+        return self.request({"type": "shutdown"})
+
+
+def connect(path=None):
+    """A client for the running daemon, None when it is not running"""
+    client = DaemonClient(path)
+    return client if client.running() else None
+
+
+def start_background(path=None, idle_timeout=None, wait=10):
+    """Start a detached daemon and wait for its socket, returns its client or None"""
+    import subprocess
+    from .config import CONFIG_DIR
+
+    settings = get_daemon_settings()
+    path = path or settings["socket"]
+    args = [sys.executable, "-m", "rallies.daemon", "--socket", path]
+    if idle_timeout is not None:
+        args += ["--idle-timeout", str(idle_timeout)]
+    os.makedirs(CONFIG_DIR, exist_ok=True)
+    with open(os.path.join(CONFIG_DIR, "daemon.log"), "a") as log:
+        subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        client = connect(path)
+        if client is not None:
+            return client
+        time.sleep(0.05)
+    return None
+
+
+def run(path=None, idle_timeout=None):
+    """Run the daemon in the foreground until it is stopped or idle"""
+    if not SUPPORTED:
+        print(UNSUPPORTED_MESSAGE, file=sys.stderr)
+        return 1
+    settings = get_daemon_settings()
+    path = path or settings["socket"]
+    idle_timeout = settings["idle_timeout"] if idle_timeout is None else idle_timeout
+    if connect(path) is not None:
+        print(f"A rallies daemon is already listening on {path}", file=sys.stderr)
+        return 1
+    print(f"rallies daemon listening on {path} (pid {os.getpid()})", flush=True)
+    try:
+        asyncio.run(Daemon(path, idle_timeout).serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the rallies daemon in the foreground")
+    parser.add_argument("--socket")
+    parser.add_argument("--idle-timeout", type=float, help="seconds without requests before it stops, 0 never stops")
+    options = parser.parse_args(argv)
+    return run(options.socket, options.idle_timeout)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
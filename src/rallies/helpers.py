@@ -1,38 +1,85 @@
 import random
-import tiktoken
-import json
 import os
-import requests
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from .llm import LLM
-from rich.markdown import Markdown
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model="gpt-4o"):
+    """Load a tiktoken encoding once per process"""
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
 
 class TokenCounter:
-    def __init__(self, model="gpt-4o"):
-        try:
-            self.encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            self.encoding = tiktoken.get_encoding("o200k_base")
-    
+    def __init__(self, model="gpt-4o", max_cached=4096):
+        self.model = model
+        self.max_cached = max_cached
+        self.total = 0
+        self._counts = OrderedDict()
+        self._tracked = []
+        self._lock = threading.RLock()
+
+    @property
+    def encoding(self):
+        return get_encoding(self.model)
+
     def count_tokens(self, text: str) -> int:
         if not text:
             return 0
-        return len(self.encoding.encode(text))
-    
+        # Counts are memoized by content hash, hashing is far cheaper than encoding
+        key = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        with self._lock:
+            count = self._counts.get(key)
+            if count is not None:
+                self._counts.move_to_end(key)
+                return count
+        count = len(self.encoding.encode(text))
+        with self._lock:
+            self._counts[key] = count
+            while len(self._counts) > self.max_cached:
+                self._counts.popitem(last=False)
+        return count
+
+    def count_message_tokens(self, message) -> int:
+        if isinstance(message, dict) and "content" in message:
+            return self.count_tokens(message["content"])
+        elif isinstance(message, str):
+            return self.count_tokens(message)
+        return 0
+
     def count_conversation_tokens(self, conversation: list) -> int:
-        total_tokens = 0
-        for message in conversation:
-            if isinstance(message, dict) and "content" in message:
-                total_tokens += self.count_tokens(message["content"])
-            elif isinstance(message, str):
-                total_tokens += self.count_tokens(message)
-        return total_tokens
+        """Count a conversation, only encoding messages added or changed since the last call"""
+        with self._lock:
+            tracked = self._tracked
+            unchanged = 0
+            for (message, content, _), current in zip(tracked, conversation):
+                if message is not current or _message_content(current) is not content:
+                    break
+                unchanged += 1
+            self.total -= sum(count for _, _, count in tracked[unchanged:])
+            del tracked[unchanged:]
+
+            for message in conversation[unchanged:]:
+                count = self.count_message_tokens(message)
+                tracked.append((message, _message_content(message), count))
+                self.total += count
+            return self.total
     
     def format_token_count(self, token_count: int) -> str:
         if token_count >= 1000:
             return f"{token_count / 1000:.1f}k tokens"
         return f"{token_count} tokens"
 
+def _message_content(message):
+    return message.get("content") if isinstance(message, dict) else message
+
+
 def get_timeout_message(elapsed_time):
     """Get appropriate message based on elapsed time"""
     
@@ -83,6 +130,11 @@ def show_help(console):
     console.print("  [white]/key API_KEY[/white]              Set up your API key")
     console.print("  [white]/feed[/white]               Show recent high-scoring questions from the community")
     console.print("  [white]/clear[/white]              Clear conversation history and free up context")
+    console.print("  [white]/cache[/white]              Show data cache usage. Optional: /cache clear|on|off")
+    console.print("  [white]/stats[/white]              Show p50/p95 latency per phase for this session")
+    console.print("  [white]/tables[/white]             List retrieved tables. Optional: /tables ID to show one")
+    console.print("  [white]/export[/white]             Export a retrieved table to CSV: /export ID [file.csv]")
+    console.print("  [white]/model[/white]              Show the model of each stage. Set one: /model STAGE MODEL[,FALLBACK]")
     console.print("  [white]/compact[/white]            Clear conversation history but keep a summary in context.")
     console.print("                      Optional: /compact [instructions for summarization]")
     console.print("  [white]/exit (quit)[/white]        Exit the REPL")
@@ -101,19 +153,194 @@ def handle_clear_command(conversation, console):
     return True
 
 
-def handle_compact_command(prompt, conversation, agent, console):
+def handle_compact_command(prompt, conversation, agent, console, token_counter):
     if len(conversation) == 0:
         console.print("[red]No conversation history to compact.[/red]")
         return True
     
     console.print("Let us compact the conversation to reduce tokens")
     conversation = agent.compact(conversation)
-    tokens = TokenCounter().count_conversation_tokens(conversation)
+    # The session's own counter, so that /compact and the turns report the same numbers
+    tokens = token_counter.count_conversation_tokens(conversation)
     console.print(f"[green]✓ Conversation condensed to {tokens} tokens. You can continue asking more questions now.[/green]")
     console.print()
     return True 
 
 
+def handle_cache_command(prompt, agent, console):
+    """Handle the /cache command"""
+    parts = prompt.strip().split()
+    action = parts[1].lower() if len(parts) > 1 else None
+
+    if agent.cache is None:
+        console.print("[red]The data cache is not available.[/red]")
+        return True
+
+    if action == "clear":
+        agent.cache.clear()
+        console.print("[green]Data cache cleared.[/green]")
+    elif action in ["on", "off"]:
+        agent.use_cache = action == "on"
+        console.print(f"[green]Data cache turned {action}.[/green]")
+    elif action is None:
+        state = "on" if agent.use_cache else "off"
+        console.print(
+            f"[white]Data cache is {state}: {len(agent.cache)} entries, "
+            f"{agent.cache.hits} hits, {agent.cache.misses} misses this session.[/white]"
+        )
+    else:
+        console.print("[red]Usage: /cache [clear|on|off][/red]")
+    return True
+
+
+def handle_tables_command(prompt, agent, console):
+    """Handle the /tables command"""
+    from rich.table import Table
+
+    parts = prompt.strip().split()
+    if agent.tables is None:
+        console.print("[red]Table compaction is turned off.[/red]")
+        return True
+
+    if len(parts) == 1:
+        tables = agent.tables.tables()
+        if not tables:
+            console.print("[yellow]No tables retrieved yet.[/yellow]")
+            return True
+        for table_id, table in tables:
+            console.print(f"  [cyan]{table_id}[/cyan]: {table.name} [dim]({table.rows} rows, {', '.join(table.columns)})[/dim]")
+        console.print()
+        return True
+
+    table = _get_table(parts[1], agent, console)
+    if table is None:
+        return True
+    view = Table(title=table.name)
+    for column in table.columns:
+        view.add_column(column, justify="right" if table.is_numeric(column) else "left")
+    limit = 20
+    indices = list(range(table.rows)) if table.rows <= limit else list(range(limit // 2)) + list(range(table.rows - limit // 2, table.rows))
+    for position, index in enumerate(indices):
+        if position and index != indices[position - 1] + 1:
+            view.add_row(*["..." for _ in table.columns])
+        view.add_row(*["" if value is None else str(value) for value in table.row(index).values()])
+    console.print(view)
+    return True
+
+
+def handle_export_command(prompt, agent, console):
+    """Handle the /export command"""
+    parts = prompt.strip().split()
+    if len(parts) < 2:
+        console.print("[red]Usage: /export TABLE_ID [file.csv][/red]")
+        return True
+    if agent.tables is None:
+        console.print("[red]Table compaction is turned off.[/red]")
+        return True
+
+    table = _get_table(parts[1], agent, console)
+    if table is None:
+        return True
+    path = parts[2] if len(parts) > 2 else f"table_{parts[1]}.csv"
+    try:
+        table.to_csv(path)
+    except OSError as e:
+        console.print(f"[red]Could not export table: {e}[/red]")
+        return True
+    console.print(f"[green]Exported {table.rows} rows to {path}[/green]")
+    return True
+
+
+def _get_table(table_id, agent, console):
+    table = agent.tables.get(int(table_id)) if table_id.isdigit() else None
+    if table is None:
+        console.print(f"[red]Table '{table_id}' not found. Use /tables to list them.[/red]")
+    return table
+
+
+def handle_stats_command(agent, console):
+    """Handle the /stats command"""
+    from rich.table import Table
+    from .tracing import tracer
+    from .llm import json_stats, usage_stats
+    from .prefetch import prefetch_stats
+
+    stats = tracer.stats()
+    if not stats:
+        console.print("[yellow]No timings recorded yet. Ask a question first.[/yellow]\n")
+        return True
+
+    table = Table(title="Latency per phase (this session)")
+    table.add_column("Phase")
+    table.add_column("Count", justify="right")
+    table.add_column("p50", justify="right")
+    table.add_column("p95", justify="right")
+    table.add_column("Total", justify="right")
+    for name in sorted(stats):
+        phase = stats[name]
+        table.add_row(
+            name, str(phase["count"]),
+            f"{phase['p50'] * 1000:.0f} ms", f"{phase['p95'] * 1000:.0f} ms", f"{phase['total']:.1f} s",
+        )
+    console.print(table)
+    if usage_stats:
+        usage = Table(title="Input tokens per stage")
+        usage.add_column("Stage")
+        usage.add_column("Calls", justify="right")
+        usage.add_column("Input", justify="right")
+        usage.add_column("Cached", justify="right")
+        usage.add_column("Hit rate", justify="right")
+        for stage in sorted(usage_stats):
+            counts = usage_stats[stage]
+            rate = counts["cached"] / counts["input"] * 100 if counts["input"] else 0
+            usage.add_row(stage, str(counts["calls"]), str(counts["input"]), str(counts["cached"]), f"{rate:.0f}%")
+        console.print(usage)
+    if json_stats:
+        paths = ", ".join(f"{path} {count}" for path, count in sorted(json_stats.items()))
+        console.print(f"[dim white]JSON responses: {paths}[/dim white]")
+    if agent.cache is not None:
+        console.print(f"[dim white]Data cache: {agent.cache.hits} hits, {agent.cache.misses} misses[/dim white]")
+    if prefetch_stats["issued"]:
+        rate = prefetch_stats["used"] / prefetch_stats["issued"] * 100
+        console.print(
+            f"[dim white]Prefetch: {prefetch_stats['issued']} issued, {prefetch_stats['used']} used ({rate:.0f}%), "
+            f"{prefetch_stats['unused']} unused, {prefetch_stats['failed']} failed[/dim white]"
+        )
+    console.print()
+    return True
+
+
+def handle_model_command(prompt, console):
+    """Handle the /model command"""
+    from .config import MODEL_STAGES, get_llm_provider, get_stage_models, get_model_timeouts, set_stage_models
+
+    parts = prompt.strip().split()
+    provider = get_llm_provider()
+    if len(parts) == 1:
+        models = get_stage_models(provider)
+        timeouts = get_model_timeouts()
+        console.print(f"\n[bright_cyan]Models ({provider.capitalize()}):[/bright_cyan]")
+        for stage in MODEL_STAGES:
+            primary, fallbacks = models[stage][0], models[stage][1:]
+            line = f"  [white]{stage:<12}[/white] {primary}"
+            if fallbacks:
+                line += f" [dim](then {', '.join(fallbacks)} after errors or {timeouts[stage]:g}s)[/dim]"
+            console.print(line)
+        console.print()
+        return True
+
+    if len(parts) != 3 or parts[1] not in MODEL_STAGES:
+        console.print(f"[red]Usage: /model STAGE MODEL[,FALLBACK...] or /model STAGE default, stages: {', '.join(MODEL_STAGES)}[/red]\n")
+        return True
+    stage = parts[1]
+    if parts[2] == "default":
+        set_stage_models(stage, None, provider)
+    else:
+        set_stage_models(stage, [model for model in parts[2].split(",") if model], provider)
+    console.print(f"[green]The {stage} now uses {' then '.join(get_stage_models(provider)[stage])}.[/green]\n")
+    return True
+
+
 def handle_exit_command(console):
     console.print("\nGoodbye!")
     import sys
@@ -121,52 +348,47 @@ def handle_exit_command(console):
 
 
 def get_config_dir():
-    """Get or create the config directory"""
-    home = Path.home()
-    config_dir = home / ".rallies"
-    config_dir.mkdir(exist_ok=True)
-    return config_dir
+    """Get the config directory, it is created when the config is first saved"""
+    from .config import CONFIG_DIR
+    return Path(CONFIG_DIR)
 
 
 def get_config_file():
     """Get the config file path"""
-    return get_config_dir() / "config.json"
+    from .config import CONFIG_FILE
+    return Path(CONFIG_FILE)
 
 
 def load_config():
     """Load configuration from file"""
-    config_file = get_config_file()
-    if config_file.exists():
-        try:
-            with open(config_file, 'r') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, IOError):
-            return {}
-    return {}
+    from .config import get_config
+    return get_config()
 
 
 def save_config(config):
     """Save configuration to file"""
-    config_file = get_config_file()
+    from .config import save_config as save
     try:
-        with open(config_file, 'w') as f:
-            json.dump(config, f)
+        save(config)
         return True
-    except IOError:
+    except (OSError, ValueError):
         return False
 
 
 def get_api_key():
     """Get the stored API key"""
-    config = load_config()
-    return config.get("api_key")
+    from .config import store
+    return store.get("api_key")
 
 
 def set_api_key(api_key):
     """Set and save the API key"""
-    config = load_config()
-    config["api_key"] = api_key
-    return save_config(config)
+    from .config import update_config
+    try:
+        update_config(api_key=api_key)
+        return True
+    except (OSError, ValueError):
+        return False
 
 
 def handle_key_command(prompt, agent, console):
@@ -186,13 +408,15 @@ def handle_key_command(prompt, agent, console):
     return True
 
 
-def handle_feed_command(console):
+def handle_feed_command(agent, console):
     """Handle the /feed command - show recent high-scoring questions"""
+    import requests
+    from rich.markdown import Markdown
     try:
         console.print("[yellow]Loading feed...[/yellow]")
         
         # Make request to the feed API
-        response = requests.get("https://rallies.ai/api/get-feed-conversations?myfeed=0", timeout=10)
+        response = agent.session.get(f"{agent.api_url}/api/get-feed-conversations?myfeed=0", timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -255,18 +479,33 @@ def handle_feed_command(console):
     return True
 
 
-def handle_command(prompt, conversation, agent, console):
+def handle_command(prompt, conversation, agent, console, token_counter):
     if prompt.strip() == "/help":
         return handle_help_command(console)
     
     if prompt.strip() == "/feed":
-        return handle_feed_command(console)
+        return handle_feed_command(agent, console)
     
     if prompt.strip() == "/clear":
         return handle_clear_command(conversation, console)
     
     if prompt.strip().startswith("/compact"):
-        return handle_compact_command(prompt, conversation, agent, console)
+        return handle_compact_command(prompt, conversation, agent, console, token_counter)
+    
+    if prompt.strip().startswith("/cache"):
+        return handle_cache_command(prompt, agent, console)
+    
+    if prompt.strip() == "/stats":
+        return handle_stats_command(agent, console)
+    
+    if prompt.strip().startswith("/tables"):
+        return handle_tables_command(prompt, agent, console)
+    
+    if prompt.strip().startswith("/export"):
+        return handle_export_command(prompt, agent, console)
+    
+    if prompt.strip().startswith("/model"):
+        return handle_model_command(prompt, console)
     
     if prompt.strip().startswith("/key"):
         return handle_key_command(prompt, agent, console)
@@ -0,0 +1,91 @@
+import json
+
+
+class JSONArrayStream:
+    """Incrementally parses a streamed JSON array and returns each element as soon as it closes
+
+    Anything before the first "[" (such as a code fence) is skipped. Elements that fail to
+    decode are skipped as well, `closed` tells whether the array was terminated.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+        self.started = False
+        self.closed = False
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.element_start = None
+
+    def feed(self, text):
+        """Add text and return the elements completed by it"""
+        elements = []
+        if self.closed or not text:
+            return elements
+        self.buffer += text
+
+        while self.position < len(self.buffer) and not self.closed:
+            char = self.buffer[self.position]
+            self.position += 1
+
+            if not self.started:
+                if char == "[":
+                    self.started = True
+                    self.depth = 1
+                continue
+
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+
+            if char == '"':
+                self.in_string = True
+                if self.depth == 1 and self.element_start is None:
+                    self.element_start = self.position - 1
+            elif char in "[{":
+                if self.depth == 1:
+                    self.element_start = self.position - 1
+                self.depth += 1
+            elif char in "]}":
+                self.depth -= 1
+                if self.depth == 1 and self.element_start is not None:
+                    elements.extend(self._decode(self.buffer[self.element_start:self.position]))
+                    self.element_start = None
+                elif self.depth == 0:
+                    # Scalars are the only elements that end at the closing bracket
+                    self._flush_scalar(elements, self.position - 1)
+                    self.closed = True
+            elif char == "," and self.depth == 1:
+                self._flush_scalar(elements, self.position - 1)
+            elif self.depth == 1 and self.element_start is None and not char.isspace():
+                self.element_start = self.position - 1
+
+        # Keep the buffer from growing with text that was already parsed
+        cut = self.position if self.element_start is None else self.element_start
+        if cut:
+            self.buffer = self.buffer[cut:]
+            self.position -= cut
+            if self.element_start is not None:
+                self.element_start -= cut
+        return elements
+
+    def _flush_scalar(self, elements, end):
+        if self.element_start is not None:
+            elements.extend(self._decode(self.buffer[self.element_start:end]))
+            self.element_start = None
+
+    @staticmethod
+    def _decode(text):
+        text = text.strip()
+        if not text:
+            return []
+        try:
+            return [json.loads(text)]
+        except json.JSONDecodeError:
+            return []
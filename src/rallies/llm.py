@@ -1,73 +1,503 @@
-import os
+import re
 import json
-import google.generativeai as genai
-from rallies.config import get_llm_provider
-from openai import OpenAI
+import time
+import asyncio
+import inspect
+import threading
+import contextvars
+from collections import Counter, OrderedDict, defaultdict
+from rallies.config import get_llm_provider, get_gemini_api_url, get_stage_models, get_model_timeouts, get_env
+from rallies.config import in_request, llm_key_name, MissingKeyError
+from rallies.tracing import tracer
 from functools import wraps
 
+# How often each JSON decoding path is taken: "native" (provider structured
+# output), "streamed" (streamed plan), "parsed" (plain text that was valid
+# JSON), "repaired", "retried" and "failed"
+json_stats = Counter()
+_json_stats_lock = threading.Lock()
+
+def record_json_path(path):
+    with _json_stats_lock:
+        json_stats[path] += 1
+
+# Token usage per stage as reported by the provider, "cached" is the part of
+# "input" that was read from the provider's prompt cache
+usage_stats = defaultdict(Counter)
+
+def record_usage(stage, input_tokens=0, cached_tokens=0, output_tokens=0):
+    with _json_stats_lock:
+        stats = usage_stats[stage or "other"]
+        stats["calls"] += 1
+        stats["input"] += input_tokens or 0
+        stats["cached"] += cached_tokens or 0
+        stats["output"] += output_tokens or 0
+
+def record_openai_usage(stage, usage):
+    if usage is None:
+        return
+    details = getattr(usage, "input_tokens_details", None)
+    record_usage(stage, usage.input_tokens, getattr(details, "cached_tokens", 0), usage.output_tokens)
+
+def record_gemini_usage(stage, response):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    record_usage(stage, usage.prompt_token_count, usage.cached_content_token_count, usage.candidates_token_count)
+
 def retry_json_decode(max_retries=3):
     def decorator(func):
         @wraps(func)
-        def wrapper(self, messages, model="gpt-4.1", requires_json=False):
+        def wrapper(self, messages, model=None, requires_json=False, schema=None, stage=None):
             if not requires_json:
-                return func(self, messages, model, requires_json)
+                return func(self, messages, model, requires_json, schema, stage)
             
             for attempt in range(max_retries):
+                started = time.perf_counter()
                 try:
-                    return func(self, messages, model, requires_json)
+                    return func(self, messages, model, requires_json, schema, stage)
                 except json.JSONDecodeError:
+                    tracer.record("llm.json_retry", time.perf_counter() - started, attempt=attempt + 1)
                     if attempt == max_retries - 1:
+                        record_json_path("failed")
                         return []
+                    record_json_path("retried")
                     continue
             
-        return wrapper
+        @wraps(func)
+        async def async_wrapper(self, messages, model=None, requires_json=False, schema=None, stage=None):
+            if not requires_json:
+                return await func(self, messages, model, requires_json, schema, stage)
+
+            for attempt in range(max_retries):
+                started = time.perf_counter()
+                try:
+                    return await func(self, messages, model, requires_json, schema, stage)
+                except json.JSONDecodeError:
+                    tracer.record("llm.json_retry", time.perf_counter() - started, attempt=attempt + 1)
+                    if attempt == max_retries - 1:
+                        record_json_path("failed")
+                        return []
+                    record_json_path("retried")
+
+        return async_wrapper if inspect.iscoroutinefunction(func) else wrapper
     return decorator
 
+def repair_json(text):
+    """Strip code fences and surrounding text and drop trailing commas"""
+    text = text.strip()
+    fence = re.match(r"^```[a-zA-Z]*\s*(.*?)\s*```$", text, re.DOTALL)
+    if fence:
+        text = fence.group(1)
+    starts = [i for i in (text.find("["), text.find("{")) if i != -1]
+    if starts:
+        text = text[min(starts):]
+    end = max(text.rfind("]"), text.rfind("}"))
+    if end != -1:
+        text = text[:end + 1]
+    return re.sub(r",\s*([\]}])", r"\1", text)
+
+def decode_json(text, schema=None, native=False):
+    """Decode a JSON response, repairing it locally before giving up
+
+    Structured output schemas wrap the value in an object, which is unwrapped here.
+    """
+    try:
+        value = json.loads(text)
+        record_json_path("native" if native else "parsed")
+    except json.JSONDecodeError:
+        value = json.loads(repair_json(text))
+        record_json_path("repaired")
+    if schema and isinstance(value, dict) and schema["key"] in value:
+        value = value[schema["key"]]
+    return value
+
+def gemini_schema(schema):
+    """Gemini's response_schema is a subset of JSON schema without additionalProperties"""
+    if isinstance(schema, dict):
+        return {key: gemini_schema(value) for key, value in schema.items() if key != "additionalProperties"}
+    if isinstance(schema, list):
+        return [gemini_schema(value) for value in schema]
+    return schema
+
+def gemini_client(api_key, asynchronous=False):
+    """A Gemini generative service client of its own for an API key
+
+    genai.configure would set the key for the whole process, clients of their own let
+    daemon requests with different keys run side by side.
+    """
+    from google.ai import generativelanguage as glm
+    from google.api_core.client_options import ClientOptions
+    endpoint = get_gemini_api_url()
+    options = ClientOptions(api_key=api_key, api_endpoint=endpoint)
+    if asynchronous:
+        return glm.GenerativeServiceAsyncClient(client_options=options)
+    # Custom endpoints, such as the benchmark server, speak REST instead of gRPC
+    return glm.GenerativeServiceClient(client_options=options, transport="rest" if endpoint else None)
+
+GEMINI_ROLES = {"assistant": "model", "agent": "model", "model": "model"}
+
+def gemini_contents(messages):
+    """Returns (system instruction, contents) for a list of chat messages
+
+    The developer and system messages the list starts with become the system
+    instruction, the rest keep their roles with consecutive messages of the same
+    role merged, so that the static prompt and the history form a stable prefix.
+    """
+    system = []
+    contents = []
+    for message in messages:
+        text = str(message["content"])
+        if not contents and message["role"] in ("developer", "system"):
+            system.append(text)
+            continue
+        if not text:
+            continue
+        role = GEMINI_ROLES.get(message["role"], "user")
+        if contents and contents[-1]["role"] == role:
+            contents[-1]["parts"].append(text)
+        else:
+            contents.append({"role": role, "parts": [text]})
+    if not contents:
+        return None, [{"role": "user", "parts": system or [""]}]
+    return "\n\n".join(system) or None, contents
+
+# Models keyed by (model name, system instruction). There are a few models and
+# a handful of static prompts per stage so this stays small.
+_gemini_models = {}
+
+def gemini_stage_model(name, system, api_key):
+    key = (name, system, api_key)
+    with _clients_lock:
+        model = _gemini_models.get(key)
+        if model is None:
+            import google.generativeai as genai
+            if len(_gemini_models) >= 32:
+                _gemini_models.clear()
+            model = _gemini_models[key] = genai.GenerativeModel(name, system_instruction=system)
+        return model
+
+async def iterate_in_thread(iterator):
+    """Consume a blocking iterator from the event loop without blocking it"""
+    loop = asyncio.get_running_loop()
+    done = object()
+    # The iterator reads the request's keys, which live in the caller's context
+    context = contextvars.copy_context()
+    while True:
+        item = await loop.run_in_executor(None, context.run, next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+# Long-lived clients keyed by (provider, api key) so that connections stay
+# warm between the planner, summarizer and answer calls. A daemon serves clients
+# with different keys, the least recently used clients are closed past MAX_CLIENTS.
+MAX_CLIENTS = 8
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+def get_client(provider, api_key):
+    """Returns the shared client for a provider and API key."""
+    key = (provider, api_key)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _clients.move_to_end(key)
+            return client
+
+        # Provider SDKs are heavy, only the one in use is ever imported
+        if provider == "gemini":
+            client = gemini_client(api_key)
+        else:
+            from openai import OpenAI
+            client = OpenAI(api_key=api_key)
+        _clients[key] = client
+        while len(_clients) > MAX_CLIENTS:
+            _, stale = _clients.popitem(last=False)
+            if hasattr(stale, "close"):
+                stale.close()
+        return client
+
+# Async clients keep connections bound to the event loop they were first used
+# on, so they are keyed by (provider, api key, loop)
+_async_clients = OrderedDict()
+
+def get_async_client(provider, api_key):
+    """Returns the async client for a provider and API key on the running event loop."""
+    loop = asyncio.get_running_loop()
+    key = (provider, api_key, loop)
+    with _clients_lock:
+        client = _async_clients.get(key)
+        if client is not None:
+            _async_clients.move_to_end(key)
+            return client
+
+        # Drop the clients of loops that are gone
+        for stale_key in [k for k in _async_clients if k[2].is_closed()]:
+            del _async_clients[stale_key]
+
+        if provider == "gemini":
+            client = gemini_client(api_key, asynchronous=True)
+        else:
+            from openai import AsyncOpenAI
+            client = AsyncOpenAI(api_key=api_key)
+        _async_clients[key] = client
+        while len(_async_clients) > MAX_CLIENTS:
+            _async_clients.popitem(last=False)
+        return client
+
+# The configured model stage each kind of call runs on
+MODEL_STAGE = {
+    "plan": "planner",
+    "summary": "summarizer",
+    "batch_summary": "summarizer",
+    "compact": "compactor",
+    "answer": "answerer",
+}
+
 class LLM:
-    def __init__(self):
-        self.llm_provider = get_llm_provider()
-        if self.llm_provider == "gemini":
-            genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-            self.client = genai.GenerativeModel('gemini-2.5-pro')
+    def __init__(self, llm_provider=None):
+        self.llm_provider = llm_provider or get_llm_provider()
+
+    @property
+    def api_key(self):
+        """The key of the provider, a daemon request's own when serving one"""
+        name = llm_key_name(self.llm_provider)
+        api_key = get_env(name)
+        if not api_key and in_request():
+            # The SDKs would fall back to the daemon's own environment, that is another user's key
+            raise MissingKeyError(f"{name} is not set")
+        return api_key
+
+    @property
+    def client(self):
+        return get_client(self.llm_provider, self.api_key)
+
+    @property
+    def async_client(self):
+        return get_async_client(self.llm_provider, self.api_key)
+
+    def json_format(self, schema):
+        return {"format": {"type": "json_schema", "name": schema["name"], "schema": schema["schema"], "strict": True}}
+
+    def gemini_config(self, schema):
+        return {"response_mime_type": "application/json", "response_schema": gemini_schema(schema["schema"])}
+
+    def route(self, stage, model=None):
+        """[(model, timeout)] to try in order, the last model has no timeout of its own
+
+        An explicit model is used on its own, otherwise the chain configured for the
+        stage is used, see /model.
+        """
+        model_stage = MODEL_STAGE.get(stage, "answerer")
+        chain = [model] if model else get_stage_models(self.llm_provider)[model_stage]
+        timeout = get_model_timeouts()[model_stage] or None
+        return [(name, timeout if index < len(chain) - 1 else None) for index, name in enumerate(chain)]
+
+    def fell_back(self, stage, model, error, started):
+        tracer.record(
+            "llm.fallback", time.perf_counter() - started,
+            stage=stage or "other", model=model, error=type(error).__name__,
+        )
+
+    def with_fallback(self, stage, model, call):
+        """Returns call(model, timeout) for the first model of the route that succeeds"""
+        route = self.route(stage, model)
+        for index, (name, timeout) in enumerate(route):
+            started = time.perf_counter()
+            try:
+                return call(name, timeout)
+            except Exception as e:
+                if index == len(route) - 1:
+                    raise
+                self.fell_back(stage, name, e, started)
+
+    async def with_fallback_async(self, stage, model, call):
+        route = self.route(stage, model)
+        for index, (name, timeout) in enumerate(route):
+            started = time.perf_counter()
+            try:
+                return await call(name, timeout)
+            except Exception as e:
+                if index == len(route) - 1:
+                    raise
+                self.fell_back(stage, name, e, started)
+
+    def openai_client(self, client, timeout):
+        # A model with a fallback fails fast instead of retrying, the fallback is the retry
+        return client.with_options(timeout=timeout, max_retries=0) if timeout else client
+
+    def openai_options(self, schema, stage):
+        options = {}
+        if schema:
+            options["text"] = self.json_format(schema)
+        if stage:
+            # Requests of a stage share their prefix, the key routes them to the same cache
+            options["prompt_cache_key"] = f"rallies-{stage}"
+        return options
+
+    def gemini_request(self, messages, model, schema, timeout, asynchronous=False):
+        """Returns the model, contents and options of a Gemini call"""
+        system, contents = gemini_contents(messages)
+        gemini = gemini_stage_model(model, system, self.api_key)
+        # GenerativeModel has no public way to take a client, it only falls back to the
+        # process wide one configured by genai.configure when these are unset
+        if asynchronous:
+            gemini._async_client = self.async_client
         else:
-            self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+            gemini._client = self.client
+        options = {}
+        if schema:
+            options["generation_config"] = self.gemini_config(schema)
+        if timeout:
+            options["request_options"] = {"timeout": timeout, "retry": None}
+        return gemini, contents, options
 
     @retry_json_decode()
-    def prompt(self, messages, model = "gpt-4.1", requires_json = False):
+    def prompt(self, messages, model = None, requires_json = False, schema = None, stage = None):
+        schema = schema if requires_json else None
         if self.llm_provider == "gemini":
-            return self.prompt_gemini(messages, requires_json)
+            call = lambda name, timeout: self.prompt_gemini(messages, name, schema, stage, timeout)
         else:
-            response = self.client.responses.create(
-                model=model,
-                input=messages
-            )
-            response = response.output_text
-            if requires_json:
-                response = json.loads(response)
-            return response
-
-    def prompt_gemini(self, messages, requires_json=False):
-        # Assuming messages is a list of dicts, concatenate content
-        prompt = "\n".join(m["content"] for m in messages)
-        response = self.client.generate_content(prompt)
+            call = lambda name, timeout: self.prompt_openai(messages, name, schema, stage, timeout)
+        response, native = self.with_fallback(stage, model, call)
         if requires_json:
-            return json.loads(response.text)
-        return response.text
+            return decode_json(response, schema, native=native)
+        return response
+
+    def prompt_openai(self, messages, model, schema=None, stage=None, timeout=None):
+        """Returns (text, whether structured output was used)"""
+        client = self.openai_client(self.client, timeout)
+        options = self.openai_options(schema, stage)
+        try:
+            response = client.responses.create(model=model, input=messages, **options)
+        except Exception as e:
+            # Models without structured output support reject the format, ask for plain text instead
+            if "text" not in options or type(e).__name__ != "BadRequestError":
+                raise
+            options.pop("text")
+            response = client.responses.create(model=model, input=messages, **options)
+        record_openai_usage(stage, response.usage)
+        return response.output_text, "text" in options
 
-    def prompt_stream(self, messages, model = "gpt-4.1"):
+    def prompt_gemini(self, messages, model, schema=None, stage=None, timeout=None):
+        gemini, contents, options = self.gemini_request(messages, model, schema, timeout)
+        response = gemini.generate_content(contents, **options)
+        record_gemini_usage(stage, response)
+        return response.text, bool(schema)
+
+    def stream(self, messages, model, schema=None, stage=None, timeout=None):
         if self.llm_provider == "gemini":
-            # Assuming messages is a list of dicts, concatenate content
-            prompt = "\n".join(m["content"] for m in messages)
-            response = self.client.generate_content(prompt, stream=True)
+            gemini, contents, options = self.gemini_request(messages, model, schema, timeout)
+            response = gemini.generate_content(contents, stream=True, **options)
+            chunk = None
             for chunk in response:
                 yield chunk.text
+            # The last chunk carries the usage of the whole response
+            record_gemini_usage(stage, chunk)
         else:
-            response = self.client.responses.create(
-                model=model,
-                input=messages,
-                stream=True
-            )
+            client = self.openai_client(self.client, timeout)
+            options = self.openai_options(schema, stage)
+            try:
+                response = client.responses.create(model=model, input=messages, stream=True, **options)
+            except Exception as e:
+                # As in prompt_openai, models without structured output get asked for plain text
+                if "text" not in options or type(e).__name__ != "BadRequestError":
+                    raise
+                options.pop("text")
+                response = client.responses.create(model=model, input=messages, stream=True, **options)
             for event in response:
                 # Listen for text delta events to get streaming content
                 if event.type == "response.output_text.delta":
                     yield event.delta
+                elif event.type == "response.completed":
+                    record_openai_usage(stage, event.response.usage)
+
+    @retry_json_decode()
+    async def prompt_async(self, messages, model = None, requires_json = False, schema = None, stage = None):
+        schema = schema if requires_json else None
+        if self.llm_provider == "gemini":
+            call = lambda name, timeout: self.prompt_gemini_async(messages, name, schema, stage, timeout)
+        else:
+            call = lambda name, timeout: self.prompt_openai_async(messages, name, schema, stage, timeout)
+        response, native = await self.with_fallback_async(stage, model, call)
+        if requires_json:
+            return decode_json(response, schema, native=native)
+        return response
+
+    async def prompt_openai_async(self, messages, model, schema=None, stage=None, timeout=None):
+        client = self.openai_client(self.async_client, timeout)
+        options = self.openai_options(schema, stage)
+        try:
+            response = await client.responses.create(model=model, input=messages, **options)
+        except Exception as e:
+            if "text" not in options or type(e).__name__ != "BadRequestError":
+                raise
+            options.pop("text")
+            response = await client.responses.create(model=model, input=messages, **options)
+        record_openai_usage(stage, response.usage)
+        return response.output_text, "text" in options
+
+    async def prompt_gemini_async(self, messages, model, schema=None, stage=None, timeout=None):
+        if get_gemini_api_url():
+            # The REST transport used for custom endpoints has no async client
+            loop = asyncio.get_running_loop()
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(None, context.run, self.prompt_gemini, messages, model, schema, stage, timeout)
+        gemini, contents, options = self.gemini_request(messages, model, schema, timeout, asynchronous=True)
+        response = await gemini.generate_content_async(contents, **options)
+        record_gemini_usage(stage, response)
+        return response.text, bool(schema)
+
+    async def prompt_stream_async(self, messages, model = None, schema = None, stage = None):
+        route = self.route(stage, model)
+        for index, (name, timeout) in enumerate(route):
+            started = time.perf_counter()
+            stream = self.stream_async(messages, name, schema, stage, timeout)
+            try:
+                try:
+                    first = await stream.__anext__()
+                except StopAsyncIteration:
+                    return
+                except Exception as e:
+                    if index == len(route) - 1:
+                        raise
+                    self.fell_back(stage, name, e, started)
+                    continue
+                yield first
+                async for chunk in stream:
+                    yield chunk
+                return
+            finally:
+                await stream.aclose()
+
+    async def stream_async(self, messages, model, schema=None, stage=None, timeout=None):
+        if self.llm_provider == "gemini" and get_gemini_api_url():
+            async for chunk in iterate_in_thread(self.stream(messages, model, schema, stage, timeout)):
+                yield chunk
+        elif self.llm_provider == "gemini":
+            gemini, contents, options = self.gemini_request(messages, model, schema, timeout, asynchronous=True)
+            response = await gemini.generate_content_async(contents, stream=True, **options)
+            chunk = None
+            async for chunk in response:
+                yield chunk.text
+            record_gemini_usage(stage, chunk)
+        else:
+            client = self.openai_client(self.async_client, timeout)
+            options = self.openai_options(schema, stage)
+            try:
+                response = await client.responses.create(model=model, input=messages, stream=True, **options)
+            except Exception as e:
+                if "text" not in options or type(e).__name__ != "BadRequestError":
+                    raise
+                options.pop("text")
+                response = await client.responses.create(model=model, input=messages, stream=True, **options)
+            try:
+                async for event in response:
+                    if event.type == "response.output_text.delta":
+                        yield event.delta
+                    elif event.type == "response.completed":
+                        record_openai_usage(stage, event.response.usage)
+            finally:
+                # Release the connection when the caller stops reading early
+                await response.close()
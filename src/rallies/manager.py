@@ -1,143 +1,341 @@
-import os
 from . import console
 from .agent.agent import Agent
 from .agent.prompts import agent_prompt
-from rich.spinner import Spinner
-from rich.live import Live
-from rich.panel import Panel
-from rich.markdown import Markdown
 import time
+import asyncio
 import threading
-from .helpers import get_timeout_message, TokenCounter, handle_command, get_api_key
+import contextvars
+from .config import get_max_parallel_steps, get_http_pool_limits, get_cache_settings, get_context_settings, get_summary_mode, get_stream_planner, get_table_settings, get_prefetch_settings, get_env, llm_key_name
+from .cache import ActionCache
+from .tables import TableStore
+from .prefetch import Prefetcher
+from .tracing import tracer
+from .context import ContextManager
+from .reporters import LiveReporter
+from .helpers import TokenCounter, handle_command, get_api_key
+
+def check_llm_key(output, provider):
+    """Returns whether the provider's key is set, and tells how to set it when it is not"""
+    if get_env(llm_key_name(provider)):
+        return True
+    if provider == "gemini":
+        output.print("[red]⚠ We need to set our Gemini API key first. Please set GEMINI_API_KEY environment variable with your Gemini API key.[/red]")
+        output.print("[dim white]e.g export GEMINI_API_KEY=... - once done open rallies again[/dim white]")
+    else:
+        output.print("[red]⚠ We need to set our OpenAI key first. Please set OPENAI_API_KEY environment variable with your OpenAI key.[/red]")
+        output.print("[dim white]e.g export OPENAI_API_KEY=sk-... - once done open rallies again[/dim white]")
+    output.print()
+    return False
+
+
+class StepError(Exception):
+    """A plan step failed, the message is shown instead of the answer"""
+
 
 class Manager:
-    def __init__(self):
+    def __init__(self, max_parallel_steps=None, use_cache=True, concurrent_turns=1):
         self.tier = "free"
+        self.max_parallel_steps = max_parallel_steps or get_max_parallel_steps()
+        self.summary_mode = get_summary_mode()
+        self.stream_planner = get_stream_planner()
         api_key = get_api_key()
-        self.agent = Agent(api_key=api_key)
+        pool_connections, pool_maxsize = get_http_pool_limits()
+        cache_settings = get_cache_settings()
+        self.agent = Agent(
+            api_key=api_key,
+            pool_connections=pool_connections,
+            pool_maxsize=max(pool_maxsize, self.max_parallel_steps * concurrent_turns),
+            cache=ActionCache(ttl=cache_settings["ttl"], max_entries=cache_settings["max_entries"]),
+        )
+        table_settings = get_table_settings()
+        if table_settings["enabled"]:
+            self.agent.tables = TableStore(
+                min_rows=max(1, table_settings["min_rows"]),
+                max_tables=max(1, table_settings["max_tables"]),
+                sample_rows=table_settings["sample_rows"],
+            )
+        self.agent.use_cache = use_cache and cache_settings["enabled"]
+        prefetch_settings = get_prefetch_settings()
+        self.prefetch_requests = prefetch_settings["max_requests"] if prefetch_settings["enabled"] else 0
         self.system_prompt = agent_prompt
         self.token_counter = TokenCounter()
 
-    def execute_plan(
-        self, planning_live, planning_content, item, prompt
-    ):
-        """Execute agent action with progressive timeout messages"""
-        result = None
-        start_time = time.time()
-
-        # Flag to track if the action is complete
-        action_complete = threading.Event()
-        def run_action():
-            nonlocal result
+        context_settings = get_context_settings()
+        self.context = ContextManager(
+            TokenCounter(),
+            budget=context_settings["budget"],
+            keep_recent_data=context_settings["keep_recent_data"],
+            stale_data_chars=context_settings["stale_data_chars"],
+        )
+        self.agent.context = self.context
+        self.auto_compact = context_settings["auto_compact"]
+        self.compact_threshold = context_settings["compact_threshold"]
+        # Background compactions keyed by the id of the conversation they compact
+        self._compactions = {}
+
+    def start_compaction(self, conversation):
+        """Compact a copy of the conversation in the background"""
+        snapshot = list(conversation)
+        compaction = {"snapshot": snapshot, "result": None, "done": threading.Event()}
+
+        def compact():
             try:
-                result = self.agent.action(prompt, item["title"], item["description"])
-            except Exception as e:
-                result = str(e)
+                compaction["result"] = self.agent.compact(list(snapshot))
+            except Exception:
+                pass
             finally:
-                action_complete.set()
-
-        # Start the action in a separate thread
-        action_thread = threading.Thread(target=run_action)
-        action_thread.start()
-
-        # Update the display while waiting
-        while not action_complete.is_set():
-            elapsed_time = time.time() - start_time
-            elapsed_seconds = int(elapsed_time)
-            timeout_message = get_timeout_message(elapsed_time)
-            
-            # Add elapsed time in brackets to the timeout message
-            timeout_message_with_time = f"{timeout_message} ({elapsed_seconds}s)"
-
-            # Update the last item in planning_content with current timeout message
-            planning_content[-1] = timeout_message_with_time
-            planning_live.update(
-                Panel("\n".join(planning_content), title="Planning", style="magenta")
-            )
+                compaction["done"].set()
+
+        self._compactions[id(conversation)] = compaction
+        # The thread runs in a copy of this context, with the keys of the request it compacts for
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(compact,), daemon=True).start()
+
+    def apply_compaction(self, conversation):
+        """Swap a finished background compaction into the conversation, returns True when applied"""
+        compaction = self._compactions.get(id(conversation))
+        if compaction is None or not compaction["done"].is_set():
+            return False
+        del self._compactions[id(conversation)]
+
+        # Only apply it when the compacted messages are still the start of this conversation
+        snapshot = compaction["snapshot"]
+        if compaction["result"] is None or len(conversation) < len(snapshot):
+            return False
+        if any(old is not current for old, current in zip(snapshot, conversation)):
+            return False
+        conversation[:len(snapshot)] = compaction["result"]
+        return True
+
+    def discard_compaction(self, conversation):
+        """Forget the background compaction of a conversation that is going away"""
+        self._compactions.pop(id(conversation), None)
+
+    async def fetch_step(self, prompt, item, index, reporter, prefetch=None, claimed=None):
+        """Retrieve the data for one plan step, returns (result, cached, error)"""
+        reporter.step_started(index)
+        started = time.time()
+        try:
+            # A speculative retrieval started with the planner may already have the data
+            prefetched = await prefetch.take(claimed) if claimed is not None else None
+            if prefetched is not None:
+                result, cached = prefetched
+            else:
+                result, cached = await self.agent.cached_action_async(prompt, item["title"], item["description"])
+        except Exception as e:
+            return None, False, str(e)
+        reporter.stage_timed("action", time.time() - started, step=index, cached=cached, prefetched=prefetched is not None)
+
+        if isinstance(result, str) and "[red]⚠" in result:
+            return None, False, result
+        if self.agent.tables is not None:
+            # Large tables reach the LLM as digests, the full table stays in the store
+            result = self.agent.tables.compact(result, item["title"])
+        reporter.step_retrieved(index, cached)
+        return result, cached, None
+
+    async def summarize_step(self, item, result, conversation, index, reporter):
+        step_messages = [
+            {"role": "user", "content": f"{item['title']} - {item['description']}"},
+            {"role": "user", "content": str(result), "type": "data"},
+        ]
+        started = time.time()
+        summary = await self.agent.summarize_async(conversation + step_messages)
+        reporter.stage_timed("summarize", time.time() - started, step=index)
+        return summary
+
+    async def summarize_round(self, plan, results, conversation, first_index, reporter):
+        """Summarize every step of a round with one LLM call, falling back to one call per step"""
+        started = time.time()
+        summaries = await self.agent.summarize_batch_async(conversation, list(zip(plan, results)))
+        reporter.stage_timed("summarize_batch", time.time() - started, steps=len(plan))
+        if isinstance(summaries, list) and len(summaries) == len(plan) and all(isinstance(s, str) for s in summaries):
+            return summaries
+        return await asyncio.gather(*[
+            self.summarize_step(item, result, conversation, first_index + offset, reporter)
+            for offset, (item, result) in enumerate(zip(plan, results))
+        ])
+
+    async def execute_plan(self, reporter, plan_items, first_index, prompt, conversation, planning_round=0, prefetch=None):
+        """Execute every step of a plan round concurrently, returns (plan, outcomes in plan order) or an error message
+
+        `plan_items` is either a list or an async iterator, such as a streaming planner, in
+        which case each step is dispatched as soon as it arrives. Steps are tasks on the
+        running loop, at most `max_parallel_steps` of them retrieve data at a time.
+
+        With the "step" summary mode a step holds its slot until it is summarized. With
+        "pipelined" the slot is released as soon as its data arrives and the summary runs
+        alongside the next retrievals. With "batch" all steps of the round are summarized
+        by a single LLM call once their data is in.
+
+        Steps matching one of the speculative retrievals of `prefetch` use its result, the
+        others are cancelled as soon as the whole round has been planned.
+        """
+        # Every step summarizes against the same snapshot so results do not
+        # depend on which step happens to finish first
+        snapshot = list(conversation)
+        plan = []
+        results = []
+        summaries = []
+        cached = []
+        tasks = []
+        claims = []
+        changed = asyncio.Event()
+        retrievals = asyncio.Semaphore(self.max_parallel_steps)
+        summarizers = asyncio.Semaphore(self.max_parallel_steps)
+
+        async def run_step(offset, item, claimed):
+            index = first_index + offset
+            async with retrievals:
+                result, cached[offset], error = await self.fetch_step(prompt, item, index, reporter, prefetch, claimed)
+                if error is not None:
+                    raise StepError(error)
+                results[offset] = result
+                if self.summary_mode == "step":
+                    summaries[offset] = await self.summarize_step(item, result, snapshot, index, reporter)
+            if self.summary_mode == "pipelined":
+                async with summarizers:
+                    summaries[offset] = await self.summarize_step(item, result, snapshot, index, reporter)
+            if summaries[offset] is not None:
+                reporter.step_finished(index, summaries[offset], cached[offset])
+
+        def start(coroutine):
+            task = asyncio.ensure_future(coroutine)
+            task.add_done_callback(lambda _: changed.set())
+            tasks.append(task)
+
+        def dispatch(item):
+            offset = len(plan)
+            plan.append(item)
+            results.append(None)
+            summaries.append(None)
+            cached.append(False)
+            reporter.steps_planned(first_index + offset, [item])
+            claimed = prefetch.claim(item) if prefetch is not None else None
+            if claimed is not None:
+                claims.append(claimed)
+            start(run_step(offset, item, claimed))
+
+        async def stream_plan():
+            started = time.time()
+            count = 0
+            async for item in plan_items:
+                if count == 0:
+                    reporter.stage_timed("plan_first_step", time.time() - started, round=planning_round)
+                count += 1
+                dispatch(item)
+            reporter.stage_timed("plan", time.time() - started, round=planning_round)
+            if prefetch is not None:
+                prefetch.discard()
+
+        if isinstance(plan_items, list):
+            for item in plan_items:
+                dispatch(item)
+            if prefetch is not None:
+                prefetch.discard()
+        else:
+            start(stream_plan())
+
+        try:
+            while True:
+                changed.clear()
+                for task in tasks:
+                    if task.done():
+                        # Surface planner and step errors
+                        task.result()
+                if all(task.done() for task in tasks):
+                    break
+                # Woken as soon as any step or the planner finishes
+                await changed.wait()
 
-            # Wait 1 second before checking again to update the timer
-            time.sleep(1.0)
+            if self.summary_mode == "batch" and plan:
+                summaries[:] = await self.summarize_round(plan, results, snapshot, first_index, reporter)
+                for offset in range(len(plan)):
+                    reporter.step_finished(first_index + offset, summaries[offset], cached[offset])
+        except StepError as e:
+            return str(e)
+        finally:
+            # Claimed retrievals of steps that never ran are cancelled along with them
+            for task in tasks + claims:
+                task.cancel()
 
-        # Wait for the thread to complete
-        action_thread.join()
+        return plan, list(zip(results, summaries))
 
-        return result
+    async def handle_command_async(self, prompt, conversation, output):
+        """handle_command off the event loop, /compact and /feed make blocking calls"""
+        loop = asyncio.get_running_loop()
+        # The executor does not carry the context over, it holds the keys of a daemon request
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            None, context.run, handle_command, prompt, conversation, self.agent, output, self.token_counter
+        )
 
-    def process_prompt(self, prompt: str, conversation: list) -> str:
+    async def process_prompt_async(self, prompt: str, conversation: list, reporter=None, output=None) -> str:
+        # Output goes to the terminal unless a console is given, such as the daemon's for a client
+        output = output or console
         # Handle commands using helpers
-        if handle_command(prompt, conversation, self.agent, console):
+        if await self.handle_command_async(prompt, conversation, output):
             return ""
         
-        if os.getenv("RALLIES") == "gemini":
-            if not os.getenv("GEMINI_API_KEY"):
-                console.print("[red]⚠ We need to set our Gemini API key first. Please set GEMINI_API_KEY environment variable with your Gemini API key.[/red]")
-                console.print("[dim white]e.g export GEMINI_API_KEY=... - once done open rallies again[/dim white]")
-                console.print()
-                return ""
-        elif not os.getenv("OPENAI_API_KEY"):
-            console.print("[red]⚠ We need to set our OpenAI key first. Please set OPENAI_API_KEY environment variable with your OpenAI key.[/red]")
-            console.print("[dim white]e.g export OPENAI_API_KEY=sk-... - once done open rallies again[/dim white]")
-            console.print()
+        if not check_llm_key(output, "gemini" if get_env("RALLIES") == "gemini" else "openai"):
             return ""
 
-        # Show initial planning spinner
-        console.print()
-        plan_spinner = Spinner(
-            "dots", text="[bright_magenta]Planning...[/bright_magenta]"
-        )
-        with Live(plan_spinner, console=console, refresh_per_second=10):
-            pass  # Initial planning display
+        return await self.run_turn_async(prompt, conversation, reporter or LiveReporter(output))
+
+    async def run_turn_async(self, prompt, conversation, reporter, token_counter=None):
+        """Plan, retrieve, summarize and answer one prompt, reporting progress to the reporter"""
+        try:
+            with tracer.span("turn"):
+                return await self._run_turn(prompt, conversation, reporter, token_counter)
+        finally:
+            tracer.flush()
 
-        # Planning pane content that streams live
-        planning_content = []
-        with Live(console=console, refresh_per_second=10) as planning_live:
+    async def _run_turn(self, prompt, conversation, reporter, token_counter=None):
+        if self.apply_compaction(conversation):
+            reporter.context_compacted()
+        turn_start = len(conversation)
+
+        reporter.planning_started()
+        step_count = 0
+        planning_round = 0
+        # Retrieve what the first round will most likely ask for while the planner thinks
+        prefetch = Prefetcher(self.agent, prompt, self.prefetch_requests)
+        prefetch = prefetch.start() if prefetch.speculations else None
+        try:
             while True:
-                # Get plan from the agent
-                plan = self.agent.run(conversation)
+                # Get plan from the agent, a streamed plan is timed as it is consumed
+                if self.stream_planner:
+                    plan_items = self.agent.run_stream_async(conversation)
+                else:
+                    started = time.time()
+                    plan_items = await self.agent.run_async(conversation)
+                    if not isinstance(plan_items, list):
+                        plan_items = []
+                    reporter.stage_timed("plan", time.time() - started, round=planning_round)
+
+                # Execute the steps of this round at once, as soon as they are planned
+                outcome = await self.execute_plan(
+                    reporter, plan_items, step_count, prompt, conversation, planning_round, prefetch
+                )
+                planning_round += 1
+                # Only the first round uses speculative retrievals, execute_plan discarded the rest
+                prefetch = None
+
+                if isinstance(outcome, str):
+                    reporter.error(outcome)
+                    self.context.prune(conversation, turn_start)
+                    return ""
+
+                plan, outcomes = outcome
                 if len(plan) == 0:
                     break
+                step_count += len(plan)
 
                 # Add to conversation
                 conversation.append({"role": "assistant", "content": str(plan)})
 
-                # Process each plan item
-                for item in plan:
-                    # Add description and update planning pane immediately
-                    planning_content.append(
-                        f"[bright_green]●[/bright_green] [white]{item['description']}[/white]"
-                    )
-                    planning_live.update(
-                        Panel(
-                            "\n".join(planning_content),
-                            title="Planning",
-                            style="magenta",
-                        )
-                    )
-
-                    # Add initial spinner message
-                    planning_content.append("[yellow] Retrieving data... (0s)[/yellow]")
-                    planning_live.update(
-                        Panel(
-                            "\n".join(planning_content),
-                            title="Planning",
-                            style="magenta",
-                        )
-                    )
-
-                    # Execute with progressive timeout display
-                    result = self.execute_plan(
-                        planning_live, planning_content, item, prompt
-                    )
-
-                    if "[red]⚠" in result:
-                        # Clear the planning pane and show only the error message
-                        planning_live.stop()
-                        console.print(result)
-                        console.print()
-                        console.print(f"[dim white]Contact us at [/dim white][link=mailto:support@rallies.ai][white]support@rallies.ai[/white][/link] [dim white]in case of any issues[/dim white]", justify="right")
-                        return ""
-
-                    # Add to conversation
+                # Add to conversation in plan order so answers stay deterministic
+                for item, (result, summary) in zip(plan, outcomes):
                     conversation.append(
                         {
                             "role": "user",
@@ -145,64 +343,64 @@ class Manager:
                         }
                     )
                     conversation.append({"role": "user", "content": str(result), "type": "data"})
-
-                    # Get summary and add to conversation
-                    summary = self.agent.summarize(conversation)
                     conversation.append({"role": "user", "content": str(summary)})
+        finally:
+            if prefetch is not None:
+                prefetch.discard()
+            reporter.planning_finished()
 
-                    # Replace spinner with summary and add new line
-                    planning_content[-1] = (
-                        f"[white]└─[/white] [bright_black]{summary}[/bright_black]"
-                    )
-                    planning_content.append("")  # Add empty line for spacing
-                    planning_live.update(
-                        Panel(
-                            "\n".join(planning_content),
-                            title="Planning",
-                            style="magenta",
-                        )
-                    )
-
-        # Stream the answer as markdown in answer pane
-        answer_text = ""
-        with Live(console=console, refresh_per_second=10) as live:
-            for chunk in self.agent.answer(prompt, conversation):
-                answer_text += chunk
-                markdown_answer = Markdown(answer_text)
-                live.update(
-                    Panel(markdown_answer, title="Answer", border_style="bright_cyan")
-                )
+        reporter.answer_started()
+        answer_parts = []
+        started = time.time()
+        try:
+            async for chunk in self.agent.answer_async(prompt, conversation):
+                if not answer_parts:
+                    reporter.stage_timed("answer_first_token", time.time() - started)
+                answer_parts.append(chunk or "")
+                reporter.answer_chunk(chunk)
+        finally:
+            answer_text = "".join(answer_parts)
+            reporter.answer_finished(answer_text)
+        reporter.stage_timed("answer", time.time() - started)
         conversation.append({"role": "assistant", "content": answer_text})
 
+        # remove large amounts of raw data to reduce token usage, in place so
+        # that later turns (and the session file) only carry the truncated data
+        self.context.prune(conversation, turn_start)
+
         # build footer with usage and token info
-        tokens = self.token_counter.count_conversation_tokens(conversation)
+        tokens = (token_counter or self.token_counter).count_conversation_tokens(conversation)
+        if self.auto_compact and tokens > self.compact_threshold and id(conversation) not in self._compactions:
+            self.start_compaction(conversation)
 
-        # remove large amounts of raw data to reduce token usage
-        conversation = [item for item in conversation if "type" not in item or item["type"] != "data"]
-        
-        usage_info = ""
+        usage_left = None
         if hasattr(self.agent, 'last_usage') and hasattr(self.agent, 'last_limit'):
-            usage_info = f"[dim white]Usage left: [/dim white][pink]{self.agent.last_limit - self.agent.last_usage}[/pink] | "
-        
-        console.print(f"{usage_info}[dim white]Tokens used: [/dim white][white]{tokens:,}[/white] | [dim white]with [/dim white][magenta]♥[/magenta] [dim white]by [/dim white][link=https://rallies.ai][dim white]rallies.ai[/dim white][/link]", justify="right")
+            usage_left = self.agent.last_limit - self.agent.last_usage
+        reporter.turn_finished(tokens, usage_left)
 
         return answer_text 
 
 
     def start(self):
         """Starts the CLI application."""
+        asyncio.run(self.start_async())
+
+    async def start_async(self):
         conversation = [{"role": "system", "content": self.system_prompt}]
+        loop = asyncio.get_running_loop()
 
         while True:
             try:
-                prompt = console.input(f"[bold bright_green]>[/bold bright_green] ")
+                # Read input off the loop so that background work keeps running
+                prompt = await loop.run_in_executor(None, console.input, f"[bold bright_green]>[/bold bright_green] ")
                 if not prompt:
                     continue
-                self.process_prompt(prompt, conversation)
+                await self.process_prompt_async(prompt, conversation)
                 console.print()
             except KeyboardInterrupt:
                 console.print("\n[bold red]Exiting...[/bold red]")
                 break
             except Exception as e:
                 console.print(f"[bold red]An unexpected error occurred: {e}[/bold red]")
-                break
\ No newline at end of file
+                break
+        await self.agent.close_async()
@@ -0,0 +1,158 @@
+import re
+import time
+import asyncio
+import threading
+from collections import Counter
+from .tracing import tracer
+
+# Upper case words that look like tickers but almost never are
+NOT_TICKERS = {
+    "A", "I", "AI", "AM", "AN", "AND", "ARE", "AS", "AT", "BE", "BY", "CEO", "CFO", "CPI", "DD", "DO",
+    "EPS", "ETF", "ETFS", "EU", "FED", "FOR", "FY", "GDP", "HOW", "IF", "IN", "IPO", "IS", "IT", "ITM",
+    "IV", "ME", "MY", "NO", "NOT", "OF", "ON", "OR", "OTM", "PE", "PM", "Q1", "Q2", "Q3", "Q4", "SEC",
+    "SO", "THE", "TO", "UK", "UP", "US", "USA", "USD", "VS", "WHAT", "WHY", "YOY", "YTD",
+}
+TICKER = re.compile(r"\$?\b[A-Z]{1,5}(?:\.[A-Z])?\b")
+
+# What the first planner round usually asks for. `prompt` words in the question
+# turn an intent on, `step` words in a plan step mean the step wants it.
+INTENTS = {
+    "quote": {
+        "prompt": None,
+        "step": ("price", "pricing", "quote", "trading", "performance", "chart"),
+        "title": "Get latest {tickers} prices",
+        "description": "I need the latest price and trading data for {tickers}",
+    },
+    "news": {
+        "prompt": None,
+        "step": ("news", "headline"),
+        "title": "Get latest {tickers} news",
+        "description": "Let me check the latest news on {tickers}",
+    },
+    "earnings": {
+        "prompt": ("earning", "eps", "report", "guidance", "quarter"),
+        "step": ("earning", "eps", "guidance"),
+        "title": "Get {tickers} earnings",
+        "description": "I need the recent earnings results of {tickers}",
+    },
+    "fundamentals": {
+        "prompt": ("valuation", "fundamental", "p/e", "multiple", "cheap", "expensive", "overvalued", "undervalued"),
+        "step": ("valuation", "fundamental", "ratio", "p/e", "multiple"),
+        "title": "Get {tickers} valuation",
+        "description": "I need the valuation metrics of {tickers}",
+    },
+}
+
+# How often speculative retrievals were "issued", "used" by a plan step,
+# "unused" once the first round was planned, and "failed"
+prefetch_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def record_prefetch(outcome, count=1):
+    with _stats_lock:
+        prefetch_stats[outcome] += count
+
+
+def extract_tickers(text, limit=3):
+    """Ticker symbols named in the text, in order, such as NVDA or $AAPL"""
+    tickers = []
+    for match in TICKER.finditer(text):
+        ticker = match.group().lstrip("$")
+        if ticker not in NOT_TICKERS and ticker not in tickers:
+            tickers.append(ticker)
+    return tickers[:limit]
+
+
+def speculate(prompt, max_requests=3):
+    """The retrievals the first planner round will most likely ask for, as plan steps"""
+    tickers = extract_tickers(prompt)
+    if not tickers:
+        return []
+    lowered = prompt.lower()
+    names = " and ".join(tickers)
+    steps = []
+    for intent, spec in INTENTS.items():
+        if spec["prompt"] and not any(word in lowered for word in spec["prompt"]):
+            continue
+        steps.append({
+            "intent": intent,
+            "tickers": tickers,
+            "title": spec["title"].format(tickers=names),
+            "description": spec["description"].format(tickers=names),
+        })
+    # Intents asked for explicitly come first, quotes and news fill the rest
+    steps.sort(key=lambda step: INTENTS[step["intent"]]["prompt"] is None)
+    return steps[:max_requests]
+
+
+def matches(speculation, item):
+    """Whether a plan step asks for the data of a speculative retrieval"""
+    text = f"{item.get('title', '')} {item.get('description', '')}"
+    if set(extract_tickers(text, limit=10)) != set(speculation["tickers"]):
+        return False
+    lowered = text.lower()
+    return any(word in lowered for word in INTENTS[speculation["intent"]]["step"])
+
+
+class Prefetcher:
+    """Speculative retrievals started from the prompt while the planner is still thinking
+
+    Each one serves at most one plan step of the first round, whatever no step claimed
+    when the round has been planned is cancelled by `discard`.
+    """
+
+    def __init__(self, agent, prompt, max_requests=3):
+        self.agent = agent
+        self.prompt = prompt
+        self.speculations = speculate(prompt, max_requests)
+        self.tasks = []
+
+    def start(self):
+        for speculation in self.speculations:
+            task = asyncio.ensure_future(self._fetch(speculation))
+            # Retrieve the outcome so that a failure nobody awaits is not logged as never retrieved
+            task.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self.tasks.append(task)
+        record_prefetch("issued", len(self.tasks))
+        return self
+
+    async def _fetch(self, speculation):
+        started = time.perf_counter()
+        try:
+            return await self.agent.cached_action_async(self.prompt, speculation["title"], speculation["description"])
+        finally:
+            tracer.record("prefetch.action", time.perf_counter() - started, intent=speculation["intent"])
+
+    def claim(self, item):
+        """The speculative retrieval matching a plan step, None without one
+
+        Steps claim their retrieval as they are planned, so that `discard` can cancel the
+        others as soon as the round is planned, before the steps have run.
+        """
+        for index, speculation in enumerate(self.speculations):
+            task = self.tasks[index] if index < len(self.tasks) else None
+            if task is not None and matches(speculation, item):
+                self.tasks[index] = None
+                return task
+        return None
+
+    async def take(self, task):
+        """(result, cached) of a claimed retrieval, None when it failed"""
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The step fetches its own data, which reports the error if it persists
+            record_prefetch("failed")
+            return None
+        record_prefetch("used")
+        return result
+
+    def discard(self):
+        unused = [task for task in self.tasks if task is not None]
+        for task in unused:
+            task.cancel()
+        self.tasks = [None] * len(self.tasks)
+        record_prefetch("unused", len(unused))
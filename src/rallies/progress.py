@@ -0,0 +1,70 @@
+import time
+import threading
+from rich.text import Text
+from rich.segment import Segment
+from .helpers import get_timeout_message
+
+
+class PlanProgress:
+    """Planning pane content with one entry per step, updated in place as steps progress
+
+    Each entry caches its rendered lines and only re-renders when its status changes.
+    Running steps show their elapsed time, which is worked out at render time, so the
+    ticker is driven by the refresh of the `Live` showing it and needs no timer of its own.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._steps = {}
+        self._lock = threading.Lock()
+
+    def add_step(self, index, description):
+        with self._lock:
+            entry = {
+                "description": f"[bright_green]●[/bright_green] [white]{description}[/white]",
+                "status": "[yellow]  Queued...[/yellow]",
+                "started": None,
+                "second": None,
+                "rendered": {},
+            }
+            self._entries.append(entry)
+            self._steps[index] = entry
+
+    def set_running(self, index, started=None):
+        with self._lock:
+            entry = self._steps[index]
+            entry["started"] = started or time.time()
+            entry["second"] = None
+
+    def set_status(self, index, status):
+        with self._lock:
+            entry = self._steps[index]
+            entry["started"] = None
+            if entry["status"] != status:
+                entry["status"] = status
+                entry["rendered"].clear()
+
+    def _tick(self, entry, now):
+        # The status of a running step changes at most once a second
+        elapsed_time = now - entry["started"]
+        second = int(elapsed_time)
+        if entry["second"] != second:
+            entry["second"] = second
+            entry["status"] = f"{get_timeout_message(elapsed_time)} ({second}s)"
+            entry["rendered"].clear()
+
+    def __rich_console__(self, console, options):
+        now = time.time()
+        width = options.max_width
+        with self._lock:
+            for entry in self._entries:
+                if entry["started"] is not None:
+                    self._tick(entry, now)
+                lines = entry["rendered"].get(width)
+                if lines is None:
+                    text = Text.from_markup(f"{entry['description']}\n{entry['status']}\n")
+                    lines = console.render_lines(text, options, pad=False)
+                    entry["rendered"][width] = lines
+                for line in lines:
+                    yield from line
+                    yield Segment.line()
@@ -0,0 +1,101 @@
+import re
+import threading
+from rich.markdown import Markdown
+from rich.segment import Segment
+
+LIST_ITEM = re.compile(r"([-*+]|\d+[.)])\s")
+
+
+class StreamingMarkdown:
+    """Markdown for streamed text that only re-parses the trailing, still open block.
+
+    Blocks closed by a blank line (outside code fences) are parsed once and their rendered
+    lines cached per width. Feed it chunks and let `Live` refresh it at its own rate.
+    """
+
+    def __init__(self):
+        self._blocks = []
+        self._rendered = []
+        self._tail = ""
+        self._tail_markdown = None
+        self._scan_pos = 0
+        self._blank_start = None
+        self._fence = None
+        self._parts = []
+        self._lock = threading.Lock()
+
+    @property
+    def text(self):
+        with self._lock:
+            return "".join(self._parts)
+
+    def feed(self, chunk):
+        if not chunk:
+            return
+        with self._lock:
+            self._parts.append(chunk)
+            self._tail += chunk
+            self._tail_markdown = None
+            self._close_blocks()
+
+    def _close_blocks(self):
+        # Only complete lines are scanned, and each of them only once
+        while True:
+            newline = self._tail.find("\n", self._scan_pos)
+            if newline == -1:
+                return
+            line_start = self._scan_pos
+            line = self._tail[line_start:newline]
+            stripped = line.strip()
+            self._scan_pos = newline + 1
+
+            if self._fence is None:
+                if not stripped:
+                    if self._blank_start is None:
+                        self._blank_start = line_start
+                    continue
+                if self._blank_start is not None and not line[0].isspace() and not LIST_ITEM.match(line):
+                    # A blank line followed by an unindented line starts a new block,
+                    # unless it is the next item of a loose list
+                    block = self._tail[:self._blank_start]
+                    if block.strip():
+                        self._blocks.append(Markdown(block))
+                        self._rendered.append({})
+                    self._tail = self._tail[line_start:]
+                    self._scan_pos -= line_start
+                self._blank_start = None
+
+            if stripped.startswith("```") or stripped.startswith("~~~"):
+                marker = stripped[:3]
+                if self._fence is None:
+                    self._fence = marker
+                elif marker == self._fence:
+                    self._fence = None
+
+    def __rich_console__(self, console, options):
+        with self._lock:
+            blocks = list(zip(self._blocks, self._rendered))
+            tail = self._tail
+            if self._tail_markdown is None and tail.strip():
+                self._tail_markdown = Markdown(tail)
+            tail_markdown = self._tail_markdown
+
+        width = options.max_width
+        rendered_blocks = []
+        for block, rendered in blocks:
+            lines = rendered.get(width)
+            if lines is None:
+                lines = console.render_lines(block, options, pad=False)
+                rendered.clear()
+                rendered[width] = lines
+            rendered_blocks.append(lines)
+        if tail_markdown is not None:
+            rendered_blocks.append(console.render_lines(tail_markdown, options, pad=False))
+
+        for index, lines in enumerate(rendered_blocks):
+            # Lists and tables already start with a blank line of their own
+            if index and lines and any(segment.text for segment in lines[0]):
+                yield Segment.line()
+            for line in lines:
+                yield from line
+                yield Segment.line()
@@ -0,0 +1,172 @@
+import threading
+from rich.text import Text
+from rich.spinner import Spinner
+from rich.live import Live
+from rich.panel import Panel
+from .render import StreamingMarkdown
+from .progress import PlanProgress
+
+
+class Reporter:
+    """Receives the progress of a Manager turn, the base class ignores everything"""
+
+    def context_compacted(self):
+        pass
+
+    def planning_started(self):
+        pass
+
+    def steps_planned(self, first_index, plan):
+        pass
+
+    def step_started(self, index):
+        pass
+
+    def step_retrieved(self, index, cached=False):
+        pass
+
+    def step_finished(self, index, summary, cached=False):
+        pass
+
+    def planning_finished(self):
+        pass
+
+    def error(self, message):
+        pass
+
+    def answer_started(self):
+        pass
+
+    def answer_chunk(self, chunk):
+        pass
+
+    def answer_finished(self, answer_text):
+        pass
+
+    def turn_finished(self, tokens, usage_left=None):
+        pass
+
+    def stage_timed(self, stage, seconds, **details):
+        pass
+
+
+class LiveReporter(Reporter):
+    """Renders a turn to the terminal with Rich Live panels"""
+
+    def __init__(self, console):
+        self.console = console
+        self.progress = PlanProgress()
+        self.planning_live = None
+        self.answer_live = None
+        self.answer_markdown = None
+
+    def context_compacted(self):
+        self.console.print("[dim white]Earlier conversation was compacted in the background to keep the context small.[/dim white]")
+
+    def planning_started(self):
+        # Show initial planning spinner
+        self.console.print()
+        plan_spinner = Spinner(
+            "dots", text="[bright_magenta]Planning...[/bright_magenta]"
+        )
+        with Live(plan_spinner, console=self.console, refresh_per_second=10):
+            pass  # Initial planning display
+
+        # Planning pane content that streams live, Live re-renders the progress
+        # at its refresh rate which also advances the step timers
+        self.planning_live = Live(
+            Panel(self.progress, title="Planning", style="magenta"),
+            console=self.console,
+            refresh_per_second=10,
+        )
+        self.planning_live.start()
+
+    def steps_planned(self, first_index, plan):
+        for index, item in enumerate(plan, first_index):
+            self.progress.add_step(index, item['description'])
+
+    def step_started(self, index):
+        self.progress.set_running(index)
+
+    def step_retrieved(self, index, cached=False):
+        self.progress.set_status(index, "[yellow]  Summarizing...[/yellow]")
+
+    def step_finished(self, index, summary, cached=False):
+        cached_tag = "[cyan](cached)[/cyan] " if cached else ""
+        self.progress.set_status(
+            index, f"[white]└─[/white] {cached_tag}[bright_black]{summary}[/bright_black]"
+        )
+
+    def planning_finished(self):
+        if self.planning_live is not None:
+            self.planning_live.stop()
+
+    def error(self, message):
+        # Clear the planning pane and show only the error message
+        self.planning_finished()
+        self.console.print(message)
+        self.console.print()
+        self.console.print(f"[dim white]Contact us at [/dim white][link=mailto:support@rallies.ai][white]support@rallies.ai[/white][/link] [dim white]in case of any issues[/dim white]", justify="right")
+
+    def answer_started(self):
+        # Stream the answer as markdown in answer pane, Live re-renders it at
+        # its refresh rate so chunks arriving in between are coalesced
+        self.answer_markdown = StreamingMarkdown()
+        answer_panel = Panel(self.answer_markdown, title="Answer", border_style="bright_cyan")
+        self.answer_live = Live(answer_panel, console=self.console, refresh_per_second=10)
+        self.answer_live.start()
+
+    def answer_chunk(self, chunk):
+        self.answer_markdown.feed(chunk)
+
+    def answer_finished(self, answer_text):
+        if self.answer_live is not None:
+            self.answer_live.stop()
+
+    def turn_finished(self, tokens, usage_left=None):
+        usage_info = ""
+        if usage_left is not None:
+            usage_info = f"[dim white]Usage left: [/dim white][pink]{usage_left}[/pink] | "
+
+        self.console.print(f"{usage_info}[dim white]Tokens used: [/dim white][white]{tokens:,}[/white] | [dim white]with [/dim white][magenta]♥[/magenta] [dim white]by [/dim white][link=https://rallies.ai][dim white]rallies.ai[/dim white][/link]", justify="right")
+
+
+class RecordingReporter(Reporter):
+    """Collects a turn's plan, answer and timings without rendering anything"""
+
+    def __init__(self):
+        self.steps = {}
+        self.timings = []
+        self.error_message = None
+        self.tokens = None
+        self.usage_left = None
+        self._lock = threading.Lock()
+
+    def steps_planned(self, first_index, plan):
+        with self._lock:
+            for index, item in enumerate(plan, first_index):
+                self.steps[index] = {"title": item.get("title"), "description": item.get("description")}
+
+    def step_finished(self, index, summary, cached=False):
+        with self._lock:
+            self.steps[index].update(summary=summary, cached=cached)
+
+    def error(self, message):
+        self.error_message = Text.from_markup(message).plain
+
+    def turn_finished(self, tokens, usage_left=None):
+        self.tokens = tokens
+        self.usage_left = usage_left
+
+    def stage_timed(self, stage, seconds, **details):
+        with self._lock:
+            self.timings.append(dict(details, stage=stage, seconds=round(seconds, 3)))
+
+    def record(self):
+        return {
+            "steps": [self.steps[index] for index in sorted(self.steps)],
+            "timings": list(self.timings),
+            "tokens": self.tokens,
+            "usage_left": self.usage_left,
+            "error": self.error_message,
+        }
@@ -0,0 +1,407 @@
+"""`rallies serve`: the plan, retrieve, summarize and answer pipeline over a local HTTP API
+
+    POST   /sessions                  new session, returns {"id"}
+    GET    /sessions                  the sessions and whether a turn is running in them
+    GET    /sessions/{id}             a session's conversation
+    GET    /sessions/{id}/stats       phase timings of a session's turns
+    DELETE /sessions/{id}             forget a session
+    POST   /sessions/{id}/turns       {"prompt": "..."}, streams the turn as Server-Sent Events
+    GET    /health                    liveness, in-flight calls and sessions
+    GET    /stats                     phase timings of all sessions, token usage and prefetch counters
+
+A turn streams planning_started, steps_planned, step_started, step_retrieved,
+step_finished, answer_chunk, answer and error events, and ends with a done event.
+Every session has its own conversation, all of them share one Manager whose LLM and
+action calls hold a slot of a single semaphore, which caps the calls in flight.
+"""
+import os
+import sys
+import json
+import time
+import secrets
+import asyncio
+from collections import OrderedDict
+from .config import get_serve_settings
+from .reporters import Reporter
+from .tracing import tracer
+
+MAX_BODY = 1024 * 1024
+REASONS = {
+    200: "OK", 201: "Created", 204: "No Content", 400: "Bad Request", 401: "Unauthorized",
+    404: "Not Found", 405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class EventReporter(Reporter):
+    """Turns the progress of a turn into Server-Sent Events on a queue"""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.tokens = None
+        self.usage_left = None
+        self.timings = []
+
+    def send(self, event, **data):
+        self.queue.put_nowait((event, data))
+
+    def context_compacted(self):
+        self.send("context_compacted")
+
+    def planning_started(self):
+        self.send("planning_started")
+
+    def steps_planned(self, first_index, plan):
+        steps = [
+            {"index": index, "title": item.get("title"), "description": item.get("description")}
+            for index, item in enumerate(plan, first_index)
+        ]
+        self.send("steps_planned", steps=steps)
+
+    def step_started(self, index):
+        self.send("step_started", index=index)
+
+    def step_retrieved(self, index, cached=False):
+        self.send("step_retrieved", index=index, cached=cached)
+
+    def step_finished(self, index, summary, cached=False):
+        self.send("step_finished", index=index, summary=str(summary), cached=cached)
+
+    def planning_finished(self):
+        self.send("planning_finished")
+
+    def error(self, message):
+        from rich.text import Text
+
+        self.send("error", message=Text.from_markup(message).plain)
+
+    def answer_chunk(self, chunk):
+        if chunk:
+            self.send("answer_chunk", text=chunk)
+
+    def answer_finished(self, answer_text):
+        self.send("answer", text=answer_text)
+
+    def turn_finished(self, tokens, usage_left=None):
+        self.tokens = tokens
+        self.usage_left = usage_left
+
+    def stage_timed(self, stage, seconds, **details):
+        self.timings.append(dict(details, stage=stage, seconds=round(seconds, 3)))
+
+
+class Session:
+    def __init__(self, system_prompt):
+        from .helpers import TokenCounter
+
+        self.id = secrets.token_hex(8)
+        self.conversation = [{"role": "system", "content": system_prompt}]
+        # Counts incrementally while it follows a single conversation, so each session has its own
+        self.token_counter = TokenCounter()
+        self.created = time.time()
+        self.last_used = time.time()
+        self.turns = 0
+        self.busy = False
+
+    def describe(self):
+        return {
+            "id": self.id,
+            "created": round(self.created, 3),
+            "last_used": round(self.last_used, 3),
+            "turns": self.turns,
+            "messages": len(self.conversation),
+            "busy": self.busy,
+        }
+
+
+class Server:
+    """Serves isolated sessions over HTTP/1.1, one request per connection"""
+
+    def __init__(self, host="127.0.0.1", port=8700, max_inflight=8, max_sessions=100, token=None, use_cache=True):
+        self.host = host
+        self.port = port
+        self.max_inflight = max_inflight
+        self.max_sessions = max_sessions
+        self.token = token
+        self.use_cache = use_cache
+        self.manager = None
+        self.sessions = OrderedDict()
+        self.started = time.time()
+
+    def start_manager(self):
+        from .config import get_max_parallel_steps
+        from .manager import Manager
+
+        # The HTTP pool holds as many connections as there can be actions in flight
+        turns = max(1, -(-self.max_inflight // get_max_parallel_steps()))
+        self.manager = Manager(use_cache=self.use_cache, concurrent_turns=turns)
+        self.manager.agent.limiter = asyncio.Semaphore(self.max_inflight)
+
+    def new_session(self):
+        session = Session(self.manager.system_prompt)
+        self.sessions[session.id] = session
+        # Forget the least recently used idle sessions past the limit
+        for old in list(self.sessions.values()):
+            if len(self.sessions) <= self.max_sessions:
+                break
+            if not old.busy:
+                self.drop_session(old)
+        return session
+
+    def drop_session(self, session):
+        self.sessions.pop(session.id, None)
+        self.manager.discard_compaction(session.conversation)
+
+    def get_session(self, session_id):
+        session = self.sessions.get(session_id)
+        if session is None:
+            raise HTTPError(404, f"No session {session_id}")
+        self.sessions.move_to_end(session_id)
+        session.last_used = time.time()
+        return session
+
+    async def read_request(self, reader):
+        """(method, path, headers, body) of the request on a connection"""
+        line = await reader.readline()
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3:
+            raise HTTPError(400, "Malformed request line")
+        method, path, _ = parts
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            raise HTTPError(400, "Malformed Content-Length")
+        if length > MAX_BODY:
+            raise HTTPError(413, "The request body is too large")
+        body = await reader.readexactly(length) if length else b""
+        return method, path.split("?", 1)[0].rstrip("/") or "/", headers, body
+
+    def respond(self, writer, status, payload=None):
+        body = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", "Connection: close", f"Content-Length: {len(body)}"]
+        if payload is not None:
+            head.append("Content-Type: application/json")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+
+    def authorized(self, headers):
+        if not self.token:
+            return True
+        return secrets.compare_digest(headers.get("authorization", ""), f"Bearer {self.token}")
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                method, path, headers, body = await self.read_request(reader)
+                if not self.authorized(headers):
+                    raise HTTPError(401, "Missing or wrong bearer token")
+                parts = path.strip("/").split("/")
+                if method == "POST" and len(parts) == 3 and parts[0] == "sessions" and parts[2] == "turns":
+                    await self.run_turn(reader, writer, self.get_session(parts[1]), body)
+                else:
+                    status, payload = self.route(method, parts)
+                    self.respond(writer, status, payload)
+            except HTTPError as e:
+                self.respond(writer, e.status, {"error": str(e)})
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def route(self, method, parts):
+        """(status, payload) of the requests that are not turns"""
+        from .llm import usage_stats
+        from .prefetch import prefetch_stats
+
+        if parts == ["health"] and method == "GET":
+            return 200, {
+                "status": "ok",
+                "uptime": round(time.time() - self.started, 1),
+                "sessions": len(self.sessions),
+                "busy_sessions": sum(session.busy for session in self.sessions.values()),
+                "inflight": self.manager.agent.inflight,
+                "max_inflight": self.max_inflight,
+            }
+        if parts == ["stats"] and method == "GET":
+            return 200, {
+                "phases": tracer.stats(everything=True),
+                "usage": {stage: dict(usage) for stage, usage in usage_stats.items()},
+                "prefetch": dict(prefetch_stats),
+            }
+        if parts == ["sessions"]:
+            if method == "POST":
+                return 201, self.new_session().describe()
+            if method == "GET":
+                return 200, {"sessions": [session.describe() for session in self.sessions.values()]}
+        elif len(parts) == 3 and parts[0] == "sessions" and parts[2] == "stats" and method == "GET":
+            session = self.get_session(parts[1])
+            with tracer.scope(session.id):
+                return 200, {"phases": tracer.stats()}
+        elif len(parts) == 2 and parts[0] == "sessions":
+            session = self.get_session(parts[1])
+            if method == "GET":
+                return 200, dict(session.describe(), conversation=session.conversation)
+            if method == "DELETE":
+                if session.busy:
+                    raise HTTPError(409, "A turn is running in this session")
+                self.drop_session(session)
+                return 204, None
+        else:
+            raise HTTPError(404, "Not found")
+        raise HTTPError(405, f"{method} is not supported here")
+
+    async def run_turn(self, reader, writer, session, body):
+        try:
+            prompt = (json.loads(body or b"{}").get("prompt") or "").strip()
+        except (ValueError, AttributeError):
+            raise HTTPError(400, "The body must be a JSON object")
+        if not prompt:
+            raise HTTPError(400, "The prompt is missing")
+        if prompt.startswith("/"):
+            raise HTTPError(400, "Slash commands are only available in the terminal")
+        if session.busy:
+            raise HTTPError(409, "A turn is already running in this session")
+
+        session.busy = True
+        queue = asyncio.Queue()
+        reporter = EventReporter(queue)
+        # Restored when the turn fails or the client goes away, so a retry starts clean
+        snapshot = list(session.conversation)
+        session.conversation.append({"role": "user", "content": prompt})
+        started = time.perf_counter()
+
+        async def turn():
+            try:
+                with tracer.scope(session.id):
+                    answer = await self.manager.run_turn_async(prompt, session.conversation, reporter, session.token_counter)
+            except asyncio.CancelledError:
+                session.conversation[:] = snapshot
+                raise
+            except Exception as e:
+                session.conversation[:] = snapshot
+                reporter.send("error", message=str(e) or type(e).__name__)
+                answer = None
+            else:
+                session.turns += 1
+            reporter.send(
+                "done",
+                answer=answer,
+                tokens=reporter.tokens,
+                usage_left=reporter.usage_left,
+                seconds=round(time.perf_counter() - started, 3),
+                timings=reporter.timings,
+            )
+            queue.put_nowait(None)
+
+        writer.write((
+            "HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+            "Connection: close\r\n\r\n"
+        ).encode("latin-1"))
+        work = asyncio.ensure_future(turn())
+        # The client hanging up cancels its turn
+        closed = asyncio.ensure_future(reader.read())
+        try:
+            while True:
+                getter = asyncio.ensure_future(queue.get())
+                await asyncio.wait({getter, closed}, return_when=asyncio.FIRST_COMPLETED)
+                if not getter.done():
+                    getter.cancel()
+                    break
+                events = [getter.result()]
+                while not queue.empty():
+                    events.append(queue.get_nowait())
+                data = "".join(
+                    f"event: {event[0]}\ndata: {json.dumps(event[1])}\n\n" for event in events if event is not None
+                )
+                writer.write(data.encode("utf-8"))
+                await writer.drain()
+                if events[-1] is None:
+                    break
+        finally:
+            closed.cancel()
+            if not work.done():
+                work.cancel()
+                # Let the turn restore the conversation before the session takes another one
+                await asyncio.gather(work, return_exceptions=True)
+            session.busy = False
+            session.last_used = time.time()
+
+    async def serve(self):
+        self.start_manager()
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.manager.agent.close_async()
+
+
+def check_keys():
+    """The error for a missing LLM API key, None when the key is set"""
+    if os.getenv("RALLIES") == "gemini":
+        if not os.getenv("GEMINI_API_KEY"):
+            return "Please set the GEMINI_API_KEY environment variable before starting the server."
+    elif not os.getenv("OPENAI_API_KEY"):
+        return "Please set the OPENAI_API_KEY environment variable before starting the server."
+    return None
+
+
+def run(args, use_cache=True):
+    """`rallies serve [--host HOST] [--port PORT] [--max-inflight N]`"""
+    from . import console
+
+    settings = get_serve_settings()
+    options = {"--host": "host", "--port": "port", "--max-inflight": "max_inflight"}
+    args = list(args)
+    while args:
+        option = args.pop(0)
+        if option not in options or not args:
+            console.print("[red]Usage: rallies serve [--host HOST] [--port PORT] [--max-inflight N][/red]")
+            return 1
+        value = args.pop(0)
+        try:
+            settings[options[option]] = value if option == "--host" else max(1, int(value))
+        except ValueError:
+            console.print(f"[red]{option} needs a number[/red]")
+            return 1
+
+    error = check_keys()
+    if error:
+        console.print(f"[red]⚠ {error}[/red]")
+        return 1
+    if settings["host"] not in ("127.0.0.1", "localhost", "::1") and not settings["token"]:
+        console.print("[yellow]⚠ Serving beyond this machine without a token, set RALLIES_SERVE_TOKEN to require one.[/yellow]")
+
+    server = Server(
+        host=settings["host"],
+        port=settings["port"],
+        max_inflight=settings["max_inflight"],
+        max_sessions=settings["max_sessions"],
+        token=settings["token"],
+        use_cache=use_cache,
+    )
+    console.print(
+        f"[green]Serving rallies on http://{settings['host']}:{settings['port']}[/green] "
+        f"[dim white](at most {settings['max_inflight']} LLM and action calls in flight, Ctrl+C stops)[/dim white]"
+    )
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run(sys.argv[1:]))
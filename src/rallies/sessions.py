@@ -0,0 +1,264 @@
+import os
+import json
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from .config import CONFIG_DIR
+from .tracing import tracer
+
+JOURNAL_SUFFIX = ".jsonl"
+LEGACY_SUFFIX = ".json"
+INDEX_FILE = os.path.join(CONFIG_DIR, "sessions_index.json")
+
+
+def session_path(session_id):
+    """Path of the journal for a session id, falling back to a legacy JSON session"""
+    journal = Path(CONFIG_DIR) / f"session_{session_id}{JOURNAL_SUFFIX}"
+    legacy = Path(CONFIG_DIR) / f"session_{session_id}{LEGACY_SUFFIX}"
+    if not journal.exists() and legacy.exists():
+        return legacy
+    return journal
+
+
+def new_session_path():
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    return Path(CONFIG_DIR) / f"session_{timestamp}{JOURNAL_SUFFIX}"
+
+
+def replay_journal(path):
+    """Replay a session journal, returns (header, subject, messages)
+
+    Lines that cannot be decoded, such as a record torn by a crash mid-write, are skipped.
+    """
+    header = {}
+    subject = None
+    messages = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            record_type = record.get("type")
+            if record_type == "session":
+                header = record
+                subject = record.get("subject", subject)
+            elif record_type == "subject":
+                subject = record.get("subject", subject)
+            elif record_type == "message":
+                messages.append(record["message"])
+            elif record_type == "truncate":
+                del messages[record.get("length", 0):]
+    return header, subject, messages
+
+
+def read_journal(path):
+    """Replay a session journal, returns (subject, messages)"""
+    _, subject, messages = replay_journal(path)
+    return subject, messages
+
+
+def load_session(path):
+    """Load a session from a journal or a legacy JSON file, returns (subject, messages)"""
+    path = Path(path)
+    if path.suffix == LEGACY_SUFFIX:
+        with open(path, "r") as f:
+            data = json.load(f)
+        return data.get("subject"), data.get("messages", [])
+    return read_journal(path)
+
+
+def convert_legacy_session(path):
+    """Convert a session_*.json file into a journal, the original is kept as .json.bak"""
+    path = Path(path)
+    subject, messages = load_session(path)
+    journal = SessionJournal(path.with_suffix(JOURNAL_SUFFIX))
+    journal.sync(messages, subject)
+    path.rename(path.with_name(path.name + ".bak"))
+    return journal.path
+
+
+class SessionJournal:
+    """Append-only session file with one JSON record per line
+
+    Only messages added since the last sync are written. When earlier messages were
+    changed or removed (e.g. by /clear or /compact) a truncate record is written first,
+    so the file never has to be rewritten.
+    """
+
+    def __init__(self, path, subject=None, messages=None):
+        self.path = Path(path)
+        self.subject = subject
+        self._written = [(message, _content(message)) for message in messages or []]
+        self._started = self.path.exists()
+        self._torn = self._started and not _ends_with_newline(self.path)
+
+    @classmethod
+    def open(cls, path):
+        """Open an existing session, converting a legacy JSON session first"""
+        path = Path(path)
+        if path.suffix == LEGACY_SUFFIX:
+            path = convert_legacy_session(path)
+        subject, messages = read_journal(path)
+        journal = cls(path, subject, messages)
+        return journal, messages
+
+    def sync(self, messages, subject=None):
+        records = []
+        if not self._started:
+            records.append({"type": "session", "subject": subject, "created": datetime.now().isoformat()})
+            self.subject = subject
+        elif subject is not None and subject != self.subject:
+            records.append({"type": "subject", "subject": subject})
+            self.subject = subject
+
+        unchanged = 0
+        for (message, content), current in zip(self._written, messages):
+            if message is not current or _content(current) is not content:
+                break
+            unchanged += 1
+        if unchanged < len(self._written):
+            records.append({"type": "truncate", "length": unchanged})
+            del self._written[unchanged:]
+
+        for message in messages[unchanged:]:
+            records.append({"type": "message", "message": message})
+            self._written.append((message, _content(message)))
+
+        if not records:
+            return
+        with tracer.span("session.sync", records=len(records)):
+            size = self._append(records)
+            self._started = True
+            SessionIndex().update(self.path, self.subject, len(messages), size)
+
+    def _append(self, records):
+        data = "".join(json.dumps(record, default=str) + "\n" for record in records).encode("utf-8")
+        if self._torn:
+            # Terminate a line torn by an earlier crash so the new records stay readable
+            data = b"\n" + data
+            self._torn = False
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            # One write per sync followed by fsync, a crash can at most tear the last line
+            while data:
+                written = os.write(fd, data)
+                data = data[written:]
+            os.fsync(fd)
+            return os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+
+class SessionIndex:
+    """Compact index of sessions so that listing them never opens session bodies
+
+    Entries are keyed by file name and hold the subject, created/updated times, message
+    count and size. The index is compared against the directory listing and file sizes
+    when read, and entries that drifted (sessions written by older versions, edited or
+    deleted files) are rebuilt from the files themselves.
+    """
+
+    def __init__(self, path=INDEX_FILE, directory=CONFIG_DIR):
+        self.path = path
+        self.directory = directory
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f).get("sessions", {})
+        except (FileNotFoundError, json.JSONDecodeError, OSError, AttributeError):
+            return {}
+
+    def _save(self, sessions):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".sessions_index.")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"sessions": sessions}, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def update(self, path, subject, message_count, size):
+        path = Path(path)
+        sessions = self._load()
+        now = datetime.now().isoformat()
+        entry = sessions.get(path.name, {})
+        sessions[path.name] = {
+            "id": session_id(path),
+            "subject": subject,
+            "created": entry.get("created", now),
+            "updated": now,
+            "messages": message_count,
+            "size": size,
+        }
+        self._save(sessions)
+
+    def sessions(self):
+        """All sessions, most recently updated first, rebuilding entries that drifted"""
+        sessions = self._load()
+        on_disk = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith("session_") and entry.name.endswith((JOURNAL_SUFFIX, LEGACY_SUFFIX)):
+                        on_disk[entry.name] = entry
+        except FileNotFoundError:
+            pass
+
+        drifted = set(sessions) - set(on_disk)
+        for stale in drifted:
+            del sessions[stale]
+        for name, entry in on_disk.items():
+            stat = entry.stat()
+            indexed = sessions.get(name)
+            if indexed is None or indexed.get("size") != stat.st_size:
+                sessions[name] = _index_entry(Path(entry.path), stat)
+                drifted.add(name)
+        if drifted:
+            self._save(sessions)
+
+        ordered = sorted(sessions.items(), key=lambda item: item[1].get("updated") or "", reverse=True)
+        return [dict(entry, path=os.path.join(self.directory, name)) for name, entry in ordered]
+
+
+def session_id(path):
+    return Path(path).stem[len("session_"):]
+
+
+def _index_entry(path, stat):
+    updated = datetime.fromtimestamp(stat.st_mtime).isoformat()
+    entry = {"id": session_id(path), "subject": None, "created": updated, "updated": updated,
+             "messages": 0, "size": stat.st_size}
+    try:
+        if path.suffix == LEGACY_SUFFIX:
+            subject, messages = load_session(path)
+            header = {}
+        else:
+            header, subject, messages = replay_journal(path)
+    except (json.JSONDecodeError, OSError, UnicodeDecodeError):
+        entry["subject"] = "Error reading session"
+        return entry
+    entry["subject"] = subject
+    entry["created"] = header.get("created", updated)
+    entry["messages"] = len(messages)
+    return entry
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def _content(message):
+    return message.get("content") if isinstance(message, dict) else message
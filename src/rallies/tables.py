@@ -0,0 +1,263 @@
+import csv
+import json
+import math
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+# Columns whose values are prices, returns and volatility are only worked out for these
+PRICE_COLUMNS = ("close", "adj_close", "adjclose", "price", "open", "high", "low", "value", "nav", "last")
+DATE_COLUMNS = ("date", "datetime", "time", "timestamp", "period", "day")
+TRADING_DAYS = 252
+# Date formats tried after ISO 8601, the first one that parses every value of a column wins
+DATE_FORMATS = ("%m/%d/%Y", "%m/%d/%y", "%d/%m/%Y", "%Y/%m/%d", "%d.%m.%Y", "%b %d, %Y", "%d %b %Y", "%Y%m%d")
+EPOCH = datetime(1970, 1, 1)
+
+
+def _is_price_column(name):
+    name = str(name).lower().replace(" ", "_")
+    return any(name == column or name.endswith("_" + column) for column in PRICE_COLUMNS)
+
+
+def _is_date_column(name):
+    name = str(name).lower()
+    return name in DATE_COLUMNS or name.endswith("_date") or name.endswith("_at")
+
+
+def _seconds(moment):
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return (moment - EPOCH).total_seconds()
+
+
+def _date_keys(values):
+    """Sortable numbers for the values of a date column, None when some cannot be read as dates"""
+    import numpy as np
+
+    if values.dtype.kind == "f":
+        # Epoch timestamps, or dates such as 20240105
+        return values if np.isfinite(values).all() else None
+    texts = [str(value).strip() for value in values]
+    try:
+        return np.array([_seconds(datetime.fromisoformat(text)) for text in texts])
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return np.array([_seconds(datetime.strptime(text, date_format)) for text in texts])
+        except ValueError:
+            continue
+    return None
+
+
+def _number(value):
+    value = float(value)
+    if not math.isfinite(value):
+        return None
+    if value.is_integer() and abs(value) < 2 ** 53:
+        return int(value)
+    return round(value, 6) if abs(value) < 1e6 else round(value, 2)
+
+
+class ColumnTable:
+    """A table held as one numpy array per column, numeric columns as float64 with NaN for gaps"""
+
+    def __init__(self, name, columns):
+        self.name = name
+        self.columns = columns
+        # Whether the rows are known to run oldest to newest, only then do first, last,
+        # returns and drawdowns mean anything
+        self.ordered = False
+
+    @classmethod
+    def from_records(cls, name, records):
+        names = []
+        for record in records:
+            for key in record:
+                if key not in names:
+                    names.append(key)
+        return cls.from_columns(name, {key: [record.get(key) for record in records] for key in names})
+
+    @classmethod
+    def from_columns(cls, name, mapping):
+        import numpy as np
+
+        columns = OrderedDict()
+        for key, values in mapping.items():
+            try:
+                array = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+                if any(isinstance(value, bool) for value in values):
+                    raise ValueError
+            except (TypeError, ValueError):
+                array = np.array(["" if value is None else value for value in values], dtype=object)
+            columns[str(key)] = array
+        table = cls(name, columns)
+        table._sort_by_date()
+        return table
+
+    def _sort_by_date(self):
+        # Results often come newest first, digests read oldest to newest
+        import numpy as np
+
+        date_column = self.date_column
+        if date_column is None:
+            return
+        keys = _date_keys(self.columns[date_column])
+        if keys is None:
+            # Sorting unreadable dates as text would misplace rows, keep the source order
+            return
+        self.ordered = True
+        order = np.argsort(keys, kind="stable")
+        if not np.array_equal(order, np.arange(len(order))):
+            for key in self.columns:
+                self.columns[key] = self.columns[key][order]
+
+    @property
+    def rows(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    @property
+    def date_column(self):
+        for key in self.columns:
+            if _is_date_column(key):
+                return key
+        return None
+
+    def is_numeric(self, key):
+        return self.columns[key].dtype.kind == "f"
+
+    def row(self, index):
+        return {key: self._value(key, index) for key in self.columns}
+
+    def _value(self, key, index):
+        value = self.columns[key][index]
+        if self.is_numeric(key):
+            return _number(value)
+        return value
+
+    def digest(self, sample_rows=3):
+        """Summary statistics sent to the LLM in place of the rows"""
+        import numpy as np
+
+        digest = {"table": self.name, "rows": self.rows, "columns": list(self.columns)}
+        date_column = self.date_column
+        if date_column is not None and self.rows:
+            if self.ordered:
+                digest["range"] = [self._value(date_column, 0), self._value(date_column, -1)]
+            else:
+                digest["unordered"] = True
+
+        stats = {}
+        for key, values in self.columns.items():
+            if not self.is_numeric(key):
+                continue
+            finite = values[np.isfinite(values)]
+            if not len(finite):
+                continue
+            column = {
+                "min": _number(finite.min()),
+                "max": _number(finite.max()),
+                "mean": _number(finite.mean()),
+            }
+            if date_column is not None and not self.ordered:
+                # Rows in an unknown order, anything that depends on it would be made up
+                stats[key] = column
+                continue
+            column = dict(first=_number(finite[0]), last=_number(finite[-1]), **column)
+            if _is_price_column(key) and len(finite) > 1 and (finite > 0).all():
+                column["return_pct"] = _number((finite[-1] / finite[0] - 1) * 100)
+                log_returns = np.diff(np.log(finite))
+                if len(log_returns) > 1:
+                    volatility = log_returns.std(ddof=1)
+                    column["volatility_pct"] = _number(volatility * 100)
+                    column["annualized_volatility_pct"] = _number(volatility * math.sqrt(TRADING_DAYS) * 100)
+                column["max_drawdown_pct"] = _number((finite / np.maximum.accumulate(finite) - 1).min() * 100)
+            stats[key] = column
+        if stats:
+            digest["stats"] = stats
+
+        if sample_rows:
+            digest["head"] = [self.row(i) for i in range(min(sample_rows, self.rows))]
+            digest["tail"] = [self.row(i) for i in range(max(sample_rows, self.rows - sample_rows), self.rows)]
+        return digest
+
+    def to_csv(self, path):
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(list(self.columns))
+            for index in range(self.rows):
+                writer.writerow(["" if value is None else value for value in self.row(index).values()])
+
+
+class TableStore:
+    """Keeps the full tables found in action results for display and export
+
+    `compact` swaps every table in a result for its digest and stores the table itself.
+    Only the most recent `max_tables` are kept.
+    """
+
+    def __init__(self, min_rows=20, max_tables=50, sample_rows=3):
+        self.min_rows = min_rows
+        self.max_tables = max_tables
+        self.sample_rows = sample_rows
+        self._tables = OrderedDict()
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def add(self, table):
+        with self._lock:
+            table_id = self._next_id
+            self._next_id += 1
+            self._tables[table_id] = table
+            while len(self._tables) > self.max_tables:
+                self._tables.popitem(last=False)
+            return table_id
+
+    def get(self, table_id):
+        with self._lock:
+            return self._tables.get(table_id)
+
+    def tables(self):
+        with self._lock:
+            return list(self._tables.items())
+
+    def compact(self, result, name="table"):
+        """Returns the result with each table replaced by its digest"""
+        if isinstance(result, str):
+            stripped = result.strip()
+            if not stripped.startswith(("[", "{")):
+                return result
+            try:
+                parsed = json.loads(stripped)
+            except json.JSONDecodeError:
+                return result
+            compacted = self._compact(parsed, name)
+            return result if compacted is parsed else compacted
+        return self._compact(result, name)
+
+    def _compact(self, value, name):
+        table = self._as_table(value, name)
+        if table is not None:
+            table_id = self.add(table)
+            return dict(table.digest(self.sample_rows), id=table_id)
+        if isinstance(value, dict):
+            compacted = {key: self._compact(item, f"{name}.{key}") for key, item in value.items()}
+            changed = any(compacted[key] is not value[key] for key in value)
+            return compacted if changed else value
+        if isinstance(value, list):
+            compacted = [self._compact(item, f"{name}[{index}]") for index, item in enumerate(value)]
+            changed = any(new is not old for new, old in zip(compacted, value))
+            return compacted if changed else value
+        return value
+
+    def _as_table(self, value, name):
+        # A list of records, or a dict of equally long columns
+        if isinstance(value, list) and len(value) >= self.min_rows:
+            if all(isinstance(row, dict) for row in value):
+                return ColumnTable.from_records(name, value)
+        elif isinstance(value, dict) and len(value) > 1:
+            lengths = {len(column) if isinstance(column, list) else -1 for column in value.values()}
+            if len(lengths) == 1 and lengths.pop() >= self.min_rows:
+                if not any(isinstance(item, (dict, list)) for column in value.values() for item in column):
+                    return ColumnTable.from_columns(name, value)
+        return None
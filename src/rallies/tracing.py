@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import atexit
+import secrets
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from .config import CONFIG_DIR, get_trace_settings
+
+TRACE_FILE = os.path.join(CONFIG_DIR, "traces.jsonl")
+
+# The span code is currently running in, asyncio tasks inherit it from the code that created them
+_current_span = contextvars.ContextVar("rallies_current_span", default=None)
+# The session spans are counted for in /stats, None in a process that serves a single session
+_current_scope = contextvars.ContextVar("rallies_trace_scope", default=None)
+
+# Durations kept per phase for the percentiles, and sessions kept by a long running daemon or server
+MAX_SAMPLES = 1000
+MAX_SCOPES = 64
+
+
+class Tracer:
+    """Records timed spans to a JSONL trace file and keeps their durations for /stats
+
+    Spans are buffered and written by `flush`, which runs at the end of every turn, so
+    the hot paths never touch the disk. With an OTLP endpoint configured every flush
+    is also exported as OTLP/HTTP JSON from a background thread.
+    """
+
+    def __init__(self, path=TRACE_FILE, enabled=None, otlp_endpoint=None, max_bytes=None):
+        self.path = path
+        self.enabled = enabled
+        self.otlp_endpoint = otlp_endpoint
+        self.max_bytes = max_bytes
+        self._buffer = []
+        # {scope: {phase: {"count", "total", "samples"}}}, the samples are the most recent durations
+        self._durations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _configure(self):
+        # Settings are read on first use so that importing this module stays free
+        if self.enabled is not None:
+            return
+        settings = get_trace_settings()
+        self.enabled = settings["enabled"]
+        self.otlp_endpoint = self.otlp_endpoint or settings["otlp_endpoint"]
+        self.max_bytes = self.max_bytes or settings["max_bytes"]
+
+    def _new_span(self, name, attributes, start):
+        parent = _current_span.get()
+        span = {
+            "name": name,
+            "trace_id": parent["trace_id"] if parent else secrets.token_hex(16),
+            "span_id": secrets.token_hex(8),
+            "parent_id": parent["span_id"] if parent else None,
+            "start": start,
+            "attributes": attributes,
+        }
+        scope = _current_scope.get()
+        if scope is not None:
+            span["session"] = scope
+        return span
+
+    @contextmanager
+    def scope(self, session):
+        """Count the spans of the block, and of the tasks it starts, for that session's /stats"""
+        token = _current_scope.set(session)
+        try:
+            yield
+        finally:
+            _current_scope.reset(token)
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time the block, yields the span attributes so that results can be added to them"""
+        self._configure()
+        if not self.enabled:
+            yield attributes
+            return
+        span = self._new_span(name, attributes, time.time())
+        token = _current_span.set(span)
+        started = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            span["error"] = str(e)[:200] or type(e).__name__
+            raise
+        finally:
+            _current_span.reset(token)
+            self._finish(span, time.perf_counter() - started)
+
+    def record(self, name, seconds, **attributes):
+        """Record a span that was timed by the caller, such as the time to a first chunk"""
+        self._configure()
+        if not self.enabled:
+            return
+        self._finish(self._new_span(name, attributes, time.time() - seconds), seconds)
+
+    def _finish(self, span, seconds):
+        span["duration_ms"] = round(seconds * 1000, 3)
+        scope = span.get("session")
+        with self._lock:
+            self._buffer.append(span)
+            phases = self._durations.get(scope)
+            if phases is None:
+                phases = self._durations[scope] = {}
+                while len(self._durations) > MAX_SCOPES:
+                    self._durations.popitem(last=False)
+            else:
+                self._durations.move_to_end(scope)
+            phase = phases.get(span["name"])
+            if phase is None:
+                phase = phases[span["name"]] = {"count": 0, "total": 0.0, "samples": deque(maxlen=MAX_SAMPLES)}
+            phase["count"] += 1
+            phase["total"] += seconds
+            phase["samples"].append(seconds)
+            flush = len(self._buffer) >= 500
+        if flush:
+            self.flush()
+
+    def stats(self, everything=False):
+        """{phase: {"count", "p50", "p95", "total"}} in seconds for the spans of the current session
+
+        Percentiles cover the last MAX_SAMPLES spans of a phase, `everything` merges all sessions.
+        """
+        with self._lock:
+            if everything:
+                scopes = list(self._durations.values())
+            else:
+                scopes = [self._durations.get(_current_scope.get(), {})]
+            merged = {}
+            for phases in scopes:
+                for name, phase in phases.items():
+                    total = merged.setdefault(name, {"count": 0, "total": 0.0, "samples": []})
+                    total["count"] += phase["count"]
+                    total["total"] += phase["total"]
+                    total["samples"].extend(phase["samples"])
+        stats = {}
+        for name, phase in merged.items():
+            samples = sorted(phase["samples"])
+            stats[name] = {
+                "count": phase["count"],
+                "p50": percentile(samples, 50),
+                "p95": percentile(samples, 95),
+                "total": phase["total"],
+            }
+        return stats
+
+    def flush(self):
+        with self._lock:
+            spans, self._buffer = self._buffer, []
+        if not spans:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+            with open(self.path, "a") as f:
+                f.write("".join(json.dumps(span, default=str) + "\n" for span in spans))
+        except OSError:
+            pass
+        if self.otlp_endpoint:
+            threading.Thread(target=export_otlp, args=(self.otlp_endpoint, spans), daemon=True).start()
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return 0
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[min(len(values), int(rank)) - 1]
+
+
+def otlp_attributes(attributes):
+    converted = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            converted.append({"key": key, "value": {"boolValue": value}})
+        elif isinstance(value, int):
+            converted.append({"key": key, "value": {"intValue": str(value)}})
+        elif isinstance(value, float):
+            converted.append({"key": key, "value": {"doubleValue": value}})
+        else:
+            converted.append({"key": key, "value": {"stringValue": str(value)}})
+    return converted
+
+
+def export_otlp(endpoint, spans):
+    """Send spans to an OpenTelemetry collector with OTLP/HTTP JSON, failures are ignored"""
+    from urllib import request
+
+    otlp_spans = []
+    for span in spans:
+        start = int(span["start"] * 1e9)
+        otlp_span = {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "name": span["name"],
+            "kind": 1,
+            "startTimeUnixNano": str(start),
+            "endTimeUnixNano": str(start + int(span["duration_ms"] * 1e6)),
+            "attributes": otlp_attributes(dict(span["attributes"], session=span["session"]) if "session" in span else span["attributes"]),
+            "status": {"code": 2, "message": span["error"]} if "error" in span else {"code": 1},
+        }
+        if span["parent_id"]:
+            otlp_span["parentSpanId"] = span["parent_id"]
+        otlp_spans.append(otlp_span)
+    body = {
+        "resourceSpans": [{
+            "resource": {"attributes": otlp_attributes({"service.name": "rallies-cli"})},
+            "scopeSpans": [{"scope": {"name": "rallies"}, "spans": otlp_spans}],
+        }]
+    }
+    url = endpoint.rstrip("/")
+    if not url.endswith("/v1/traces"):
+        url += "/v1/traces"
+    try:
+        req = request.Request(url, data=json.dumps(body).encode("utf-8"), headers={"Content-Type": "application/json"})
+        request.urlopen(req, timeout=5).close()
+    except Exception:
+        pass
+
+
+tracer = Tracer()
+atexit.register(tracer.flush)